@@ -4,14 +4,145 @@ SNES ZMZ Emulator - Full Implementation
 A working SNES emulator with CPU (65C816), PPU, APU, and controller support
 """
 
-import tkinter as tk
-from tkinter import filedialog, messagebox
+import time
+MODULE_START = time.perf_counter()
 import struct
 import os
+import sys
+import importlib
+import json
+import argparse
+import platform
+import sqlite3
+import threading
+import socket
+import queue
+from concurrent.futures import ProcessPoolExecutor
+import math
+import wave
+import zlib
+import lzma
+import hashlib
+import gzip
+import zipfile
+import mmap
+from array import array
+from collections import deque
 from pathlib import Path
 
+class LazyModule:
+    """Stand-in for a slow-to-import module: imports it on first attribute
+    access and then rebinds its global name to the real module"""
+    def __init__(self, name, alias):
+        self.name = name
+        self.alias = alias
+    
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.name)
+        globals()[self.alias] = module
+        return getattr(module, attr)
+
+# NumPy is only needed once audio or profiling runs, and Tk only for the UI
+np = LazyModule('numpy', 'np')
+tk = LazyModule('tkinter', 'tk')
+filedialog = LazyModule('tkinter.filedialog', 'filedialog')
+messagebox = LazyModule('tkinter.messagebox', 'messagebox')
+simpledialog = LazyModule('tkinter.simpledialog', 'simpledialog')
+
+# Savestate container: magic, version, codec, uncompressed payload size
+STATE_MAGIC = b'ZMZS'
+STATE_VERSION = 5
+STATE_HEADER = struct.Struct('<4sHBxI')
+STATE_CODECS = {None: 0, 'zlib': 1, 'lzma': 2}
+
+# Movie file: magic, version, ROM SHA-1, frame count; then (repeat, mask) runs
+MOVIE_MAGIC = b'ZMZM'
+MOVIE_VERSION = 1
+MOVIE_HEADER = struct.Struct('<4sH20sI')
+MOVIE_RUN = struct.Struct('<HH')
+
+def mirror_offset(offset, size):
+    """Fold a ROM offset into a ROM of any size the way the cartridge
+    mirrors it: power-of-two chunks past the end repeat the last chunk."""
+    base = 0
+    mask = 1 << 23
+    while offset >= size:
+        while not offset & mask:
+            mask >>= 1
+        offset -= mask
+        if size > mask:
+            size -= mask
+            base += mask
+        mask >>= 1
+    return base + offset
+
+class ROMHeader:
+    """Internal cartridge header found at one mapping's header address"""
+    # Opcodes commonly found at a reset vector
+    RESET_OPCODES = (0x78, 0x18, 0x38, 0x9C, 0x4C, 0x5C, 0xC2, 0xE2, 0xA9, 0xA2, 0xA0, 0x20, 0x22)
+    MAP_MODES = {'lorom': (0x20, 0x22), 'hirom': (0x21,), 'exhirom': (0x25,)}
+    
+    def __init__(self, rom, mapping, base):
+        header = bytes(rom[base:base + 0x40])
+        self.mapping = mapping
+        self.base = base
+        self.raw_title = header[:21]
+        self.title = self.raw_title.decode('ascii', 'replace').strip()
+        self.map_mode = header[0x15]
+        self.rom_type = header[0x16]
+        self.rom_size = header[0x17]
+        self.sram_size = 1024 << header[0x18] if 0 < header[0x18] <= 0x0A else 0
+        self.region = header[0x19]
+        self.version = header[0x1B]
+        self.complement, self.checksum = struct.unpack_from('<HH', header, 0x1C)
+        self.reset_vector, = struct.unpack_from('<H', header, 0x3C)
+        self.fast_rom = bool(self.map_mode & 0x10)
+        self.score = self.rate(rom)
+        
+    def rate(self, rom):
+        score = 0
+        if self.map_mode & ~0x10 in self.MAP_MODES[self.mapping]:
+            score += 2
+        if self.checksum ^ self.complement == 0xFFFF:
+            score += 3
+        if self.reset_vector >= 0x8000:
+            reset = (self.base & ~0xFFFF) | self.reset_vector
+            if self.mapping == 'lorom':
+                reset = self.reset_vector - 0x8000
+            if reset < len(rom) and rom[reset] in self.RESET_OPCODES:
+                score += 2
+        else:
+            score -= 4
+        if all(32 <= c < 127 for c in self.raw_title):
+            score += 1
+        if 0x07 <= self.rom_size <= 0x0D:
+            score += 1
+        if self.sram_size <= 0x40000:
+            score += 1
+        return score
+
+def detect_header(rom):
+    """Return the best-scoring ROMHeader, or None for images too small to have one"""
+    candidates = [ROMHeader(rom, mapping, base)
+                  for mapping, base in (('lorom', 0x7FC0), ('hirom', 0xFFC0), ('exhirom', 0x40FFC0))
+                  if base + 0x40 <= len(rom)]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda header: header.score)
+
 class Memory:
-    """SNES Memory Management Unit"""
+    """SNES Memory Management Unit
+    
+    Reads and writes go through a table of 4KB pages built once per ROM
+    load for the mapping its header declares. A page is either a memoryview
+    into the backing RAM/ROM/SRAM or None, which sends the access to the
+    slow path (I/O registers, open bus, SRAM smaller than a page and
+    watched pages).
+    """
+    STATE_REGIONS = ('wram', 'sram', 'vram', 'cgram', 'oam')
+    PAGE_SHIFT = 12
+    PAGE_SIZE = 0x1000
+    
     def __init__(self):
         self.wram = bytearray(128 * 1024)  # 128KB Work RAM
         self.sram = bytearray(32 * 1024)   # 32KB Save RAM
@@ -19,191 +150,3368 @@ class Memory:
         self.cgram = bytearray(512)        # 512B Palette RAM
         self.oam = bytearray(544)          # 544B Object Attribute Memory
         self.rom = bytearray()
-        self.rom_banks = []
+        self.header = None
+        self.mapping = 'lorom'
+        self.masked_pages = {}  # page -> (memory, mask) for sub-page mirrors
+        # I/O register handlers for $2000-$5FFF in banks $00-$3F/$80-$BF
+        self.io_read = {}   # offset -> handler(offset)
+        self.io_write = {}  # offset -> handler(offset, value)
+        self.sram_pages = set()  # pages backed by SRAM, full or masked
+        self.sram_dirty = False
+        self.battery = None  # mmap of the .srm file SRAM is flushed to, if any
+        self.battery_path = None  # that file, kept while the battery is detached
+        self.rom_cheats = {}  # bus address -> value, e.g. from Game Genie
+        self.memsel = 0  # $420D bit 0: banks $80-$FF ROM at FastROM speed
+        self.watchpoints = []  # (start, end, callback, read, write)
+        self.read_watches = {}   # page -> watchpoints covering it
+        self.write_watches = {}
+        self.generation = 0  # bumped when memory changes wholesale, not byte by byte
+        self.hooks = {}  # read/write -> wrappers shadowing it (see add_hook)
+        self.build_page_table()
+        
+    def load_rom(self, data, sram_path=None, battery=True):
+        """Load ROM data, detect its mapping and build the page table
+        
+        data can be any buffer (bytes, bytearray, mmap); it is used as-is.
+        With sram_path, SRAM starts as a copy of that .srm file. With battery
+        it is flushed back to an mmap of the file, otherwise the copy is
+        private and the file is never written.
+        """
+        self.detach_battery()
+        self.battery_path = None
+        self.rom = data
+        self.header = detect_header(self.rom)
+        if self.header is not None:
+            self.mapping = self.header.mapping
+            size = self.header.sram_size
+            if sram_path and size and battery:
+                self.battery_path = sram_path
+                self.battery = open_sram(sram_path, size)
+                self.sram = bytearray(self.battery)
+            elif sram_path and size:
+                self.sram = read_sram(sram_path, size)
+            else:
+                self.sram = bytearray(size)
+        else:
+            self.mapping = 'lorom'
+        self.sram_dirty = False
+        self.build_page_table()
+    
+    def flush_sram(self):
+        """Write dirty battery SRAM back to its .srm file; True if it was dirty
+        
+        SRAM pages take the slow path only until the first write after a
+        flush, which marks them dirty and puts them back on the fast path.
+        The bus only ever sees the private sram buffer, so power-on and
+        savestate loads never reach the file; only flushes do.
+        """
+        if not self.sram_dirty:
+            return False
+        if self.battery is not None:
+            self.battery[:] = self.sram
+            self.battery.flush()
+        self.sram_dirty = False
+        self.refresh_watches()
+        return True
+    
+    def detach_battery(self):
+        """Flush SRAM, then stop writing it to its .srm file"""
+        self.flush_sram()
+        if self.battery is not None:
+            self.battery.close()
+            self.battery = None
+    
+    def attach_battery(self):
+        """Undo detach_battery: reload SRAM from its .srm file and flush
+        there again; a no-op if the ROM has no battery save"""
+        if self.battery is not None or self.battery_path is None:
+            return
+        self.battery = open_sram(self.battery_path, len(self.sram))
+        self.sram[:] = self.battery
+        self.sram_dirty = False
+        self.generation += 1
+        self.refresh_watches()
+    
+    def mark_sram_dirty(self):
+        self.sram_dirty = True
+        self.refresh_watches()
+        
+    def build_page_table(self):
+        """Map every 4KB page of the 24-bit bus to its backing memory"""
+        size = self.PAGE_SIZE
+        read_pages = [None] * 4096
+        write_pages = [None] * 4096
+        self.masked_pages = {}
+        self.sram_pages = set()
+        wram = memoryview(self.wram)
+        rom = memoryview(self.rom)
+        sram = memoryview(self.sram)
+        mapping = self.mapping
+        
+        def map_rom(index, offset):
+            if not len(rom):
+                return
+            offset = mirror_offset(offset, len(rom))
+            page = rom[offset:offset + size]
+            if len(page) < size:
+                page = memoryview(bytes(page).ljust(size, b'\0'))
+            read_pages[index] = page
+        
+        def map_sram(index, offset):
+            if len(sram):
+                self.sram_pages.add(index)
+            if len(sram) >= size:
+                offset %= len(sram)
+                read_pages[index] = write_pages[index] = sram[offset:offset + size]
+            elif len(sram):
+                self.masked_pages[index] = (sram, len(sram) - 1)
+        
+        for bank in range(256):
+            base = bank << 4
+            # WRAM: $7E0000-$7FFFFF
+            if bank == 0x7E or bank == 0x7F:
+                for i in range(16):
+                    start = ((bank - 0x7E) << 16) | (i << 12)
+                    read_pages[base + i] = write_pages[base + i] = wram[start:start + size]
+                continue
+            
+            # System banks $00-$3F/$80-$BF: low RAM mirror at $0000-$1FFF,
+            # I/O at $2000-$5FFF (slow path)
+            system = not bank & 0x40
+            if system:
+                for i in range(2):
+                    read_pages[base + i] = write_pages[base + i] = wram[i * size:(i + 1) * size]
+            
+            for i in range(16):
+                index = base + i
+                offset = i << 12
+                if system and offset < 0x6000:
+                    continue
+                if mapping == 'lorom':
+                    # 32KB ROM banks at $8000; banks $70-$7D/$F0-$FF hold SRAM below it
+                    if offset >= 0x8000 or (not system and (bank & 0x7F) < 0x70):
+                        map_rom(index, (bank & 0x7F) * 0x8000 + (offset & 0x7FFF))
+                    elif not system:
+                        map_sram(index, (bank & 0x0F) * 0x8000 + offset)
+                else:
+                    # 64KB ROM banks; ExHiROM puts the second 4MB in $40-$7D
+                    high = 0x400000 if mapping == 'exhirom' and not bank & 0x80 else 0
+                    if offset >= 0x8000 or not system:
+                        map_rom(index, high | ((bank & 0x3F) << 16) | offset)
+                    elif (bank & 0x7F) >= 0x20 and offset >= 0x6000:
+                        # 8KB SRAM windows at $6000-$7FFF of banks $20-$3F/$A0-$BF
+                        map_sram(index, (bank & 0x1F) * 0x2000 + (offset & 0x1FFF))
+        
+        # ROM cheats replace just their own page with a patched copy, so
+        # mirrors of the address and the ROM image stay untouched
+        overlays = {}
+        for addr, value in self.rom_cheats.items():
+            index = addr >> 12
+            if read_pages[index] is not None and write_pages[index] is None:
+                if index not in overlays:
+                    overlays[index] = bytearray(read_pages[index])
+                overlays[index][addr & 0xFFF] = value
+        for index, page in overlays.items():
+            read_pages[index] = memoryview(page)
+        
+        self.read_backing = read_pages
+        self.write_backing = write_pages
+        self.read_pages = list(read_pages)
+        self.write_pages = list(write_pages)
+        self.generation += 1
+        self.refresh_watches()
+        
+    def state_chunks(self):
+        """Savestate chunks: region sizes, then each region as a memoryview"""
+        regions = [getattr(self, name) for name in self.STATE_REGIONS]
+        sizes = struct.pack('<5I', *[len(region) for region in regions])
+        return [sizes] + [memoryview(region) for region in regions]
+    
+    def load_state(self, view, offset):
+        """Restore regions from a savestate payload; returns the new offset"""
+        sizes = struct.unpack_from('<5I', view, offset)
+        offset += 20
+        for name, size in zip(self.STATE_REGIONS, sizes):
+            region = getattr(self, name)
+            if size != len(region):
+                raise ValueError(f"Savestate {name} size {size} != {len(region)}")
+            region[:] = view[offset:offset + size]
+            offset += size
+        # SRAM is not marked dirty: a loaded state reaches the .srm file only
+        # once the game itself writes SRAM again
+        self.generation += 1
+        return offset
+    
+    def clear(self):
+        """Zero every STATE_REGIONS region, as at power-on"""
+        for name in self.STATE_REGIONS:
+            region = getattr(self, name)
+            region[:] = bytes(len(region))
+        self.generation += 1
+    
+    def read(self, addr):
+        """Read byte from memory address"""
+        page = self.read_pages[(addr >> 12) & 0xFFF]
+        if page is not None:
+            return page[addr & 0xFFF]
+        return self.read_slow(addr)
+    
+    def write(self, addr, value):
+        """Write byte to memory address"""
+        page = self.write_pages[(addr >> 12) & 0xFFF]
+        if page is not None:
+            page[addr & 0xFFF] = value & 0xFF
+        else:
+            self.write_slow(addr, value & 0xFF)
+    
+    def peek(self, addr):
+        """Read without I/O side effects or watchpoints; I/O reads as 0"""
+        index = (addr >> 12) & 0xFFF
+        page = self.read_backing[index]
+        if page is not None:
+            return page[addr & 0xFFF]
+        if index in self.masked_pages:
+            memory, mask = self.masked_pages[index]
+            return memory[addr & mask]
+        return 0
+    
+    @staticmethod
+    def home(addr):
+        """Canonical bus address of addr's byte: the low RAM mirror at
+        $0000-$1FFF of every system bank folds to $7E0000-$7E1FFF"""
+        if not addr & 0x40E000:
+            return 0x7E0000 | (addr & 0x1FFF)
+        return addr & 0xFFFFFF
+    
+    @staticmethod
+    def mirror_pages(index):
+        """Every bus page backed by the same memory as page index"""
+        home = Memory.home(index << 12) >> 12
+        if home in (0x7E0, 0x7E1):
+            return [home] + [(bank << 4) | (home & 1) for bank in range(256) if not bank & 0x40]
+        return [index]
+    
+    def access_clocks(self, addr):
+        """Master clocks one CPU access to addr takes: 6 fast, 8 slow,
+        12 for the $4000-$41FF joypad ports"""
+        bank = (addr >> 16) & 0xFF
+        offset = addr & 0xFFFF
+        if offset >= 0x8000 or bank & 0x40:
+            # ROM (and WRAM in $7E/$7F); FastROM only in the upper banks
+            if bank & 0x80 and self.memsel:
+                return 6
+            return 8
+        if offset < 0x2000 or offset >= 0x6000:
+            return 8
+        if 0x4000 <= offset < 0x4200:
+            return 12
+        return 6
+    
+    def read_slow(self, addr):
+        """Reads from unmapped, I/O or watched pages"""
+        index = (addr >> 12) & 0xFFF
+        backing = self.read_backing[index]
+        if backing is not None:
+            value = backing[addr & 0xFFF]
+        elif index in self.masked_pages:
+            memory, mask = self.masked_pages[index]
+            value = memory[addr & mask]
+        else:
+            value = self.read_io(addr)
+        watches = self.read_watches.get(index)
+        if watches:
+            addr &= 0xFFFFFF
+            for start, end, callback, _, _ in watches:
+                if start <= addr <= end:
+                    callback('read', addr, value)
+        return value
+    
+    def write_slow(self, addr, value):
+        """Writes to read-only, I/O or watched pages"""
+        index = (addr >> 12) & 0xFFF
+        if not self.sram_dirty and index in self.sram_pages:
+            self.mark_sram_dirty()
+        backing = self.write_backing[index]
+        if backing is not None:
+            backing[addr & 0xFFF] = value
+        elif index in self.masked_pages:
+            memory, mask = self.masked_pages[index]
+            memory[addr & mask] = value
+        else:
+            self.write_io(addr, value)
+        watches = self.write_watches.get(index)
+        if watches:
+            addr &= 0xFFFFFF
+            for start, end, callback, _, _ in watches:
+                if start <= addr <= end:
+                    callback('write', addr, value)
+    
+    def read_io(self, addr):
+        # I/O registers: $2000-$5FFF in banks $00-$3F/$80-$BF
+        offset = addr & 0xFFFF
+        if 0x2000 <= offset < 0x6000 and not addr & 0x400000:
+            handler = self.io_read.get(offset)
+            if handler:
+                return handler(offset)
+        return 0
+    
+    def write_io(self, addr, value):
+        offset = addr & 0xFFFF
+        if 0x2000 <= offset < 0x6000 and not addr & 0x400000:
+            handler = self.io_write.get(offset)
+            if handler:
+                handler(offset, value)
+    
+    def watch(self, start, end, callback, read=True, write=True):
+        """Call callback(kind, addr, value) on accesses to bus addresses
+        start..end (inclusive). Only the pages covering the range leave the
+        fast path; mirrors of the range are not watched.
+        """
+        watchpoint = (start & 0xFFFFFF, end & 0xFFFFFF, callback, read, write)
+        self.watchpoints.append(watchpoint)
+        self.refresh_watches()
+        return watchpoint
+    
+    def watch_pages(self, pages, callback, read=True, write=True):
+        """watch() each whole 4KB page in pages with one table refresh;
+        returns the watchpoints"""
+        watchpoints = [(index << 12, (index << 12) | 0xFFF, callback, read, write)
+                       for index in pages]
+        self.watchpoints += watchpoints
+        self.refresh_watches()
+        return watchpoints
+    
+    def unwatch(self, *watchpoints):
+        for watchpoint in watchpoints:
+            self.watchpoints.remove(watchpoint)
+        self.refresh_watches()
+        
+    def refresh_watches(self):
+        """Route watched (and clean SRAM) pages to the slow path and restore
+        the others"""
+        self.read_watches = {}
+        self.write_watches = {}
+        for watchpoint in self.watchpoints:
+            start, end, _, read, write = watchpoint
+            for index in range(start >> 12, (end >> 12) + 1):
+                if read:
+                    self.read_watches.setdefault(index, []).append(watchpoint)
+                if write:
+                    self.write_watches.setdefault(index, []).append(watchpoint)
+        trapped = self.write_watches if self.sram_dirty else self.write_watches.keys() | self.sram_pages
+        for index in range(4096):
+            self.read_pages[index] = None if index in self.read_watches else self.read_backing[index]
+            self.write_pages[index] = None if index in trapped else self.write_backing[index]
+
+class CPU65C816:
+    """65C816 CPU Emulation
+    
+    Cycles come from CYCLE_TABLES for the current register widths. The
+    'accurate' timing profile also charges direct page alignment, index
+    page crossing and the wait states of every byte fetched, at the cost
+    of running through step() one instruction at a time.
+    """
+    STATE = struct.Struct('<HHHHHHBBBBBBQ')
+    RUN_UNTIL_LIMIT = 1 << 24  # default run_until cycles, should event never come
+    
+    def __init__(self, memory, profile='fast'):
+        self.mem = memory
+        self.profile = profile  # one of CPU_TIMING_PROFILES
+        self.a = 0      # Accumulator
+        self.x = 0      # X index
+        self.y = 0      # Y index
+        self.sp = 0x1FF # Stack pointer
+        self.pc = 0     # Program counter
+        self.pb = 0     # Program bank
+        self.db = 0     # Data bank
+        self.p = 0x34   # Processor status
+        self.e = 1      # Emulation mode
+        self.d = 0      # Direct page
+        self.cycles = 0
+        self.wait_clocks = 0  # master clocks of wait states not yet a cycle
+        self.steps_left = 0  # instructions run() still had to go when a step hook raised
+        self.hooks = {}  # step -> wrappers shadowing it (see add_hook)
+        self.debugger = None  # Debugger, while it has breakpoints or watchpoints
+        
+    def reset(self):
+        """Reset CPU to initial state"""
+        reset_vector = self.mem.read(0xFFFC) | (self.mem.read(0xFFFD) << 8)
+        self.pc = reset_vector
+        self.pb = 0
+        self.sp = 0x1FF
+        self.p = 0x34
+        self.e = 1
+        
+    def step(self):
+        """Execute one instruction"""
+        if len(self.mem.rom) == 0:
+            return
+        debugger = self.debugger
+        if debugger is not None:
+            debugger.before((self.pb << 16) | self.pc)
+        
+        if self.profile == 'accurate':
+            addr = (self.pb << 16) | self.pc
+            opcode = self.fetch_byte()
+            self.cycles += self.extra_cycles(addr, opcode)
+        else:
+            opcode = self.fetch_byte()
+        self.execute_opcode(opcode)
+        if debugger is not None:
+            debugger.after()
+    
+    def extra_cycles(self, addr, opcode):
+        """Accurate-profile cycles on top of the table for the instruction
+        at addr, found by peeking at its operand without side effects"""
+        mem = self.mem
+        _, direct, indexed = OPCODE_TIMING[opcode]
+        size = OPERAND_SIZES[4 if self.e else (self.p >> 4) & 3][opcode]
+        pc = addr & 0xFFFF
+        extra = 1 if direct and self.d & 0xFF else 0
+        if indexed and (self.e or self.p & 0x10):
+            operand = mem.peek((addr & 0xFF0000) | ((pc + 1) & 0xFFFF))
+            if indexed == 'idpy':
+                base, index = mem.peek((self.d + operand) & 0xFFFF), self.y
+            else:
+                base, index = operand, self.x if indexed == 'absx' else self.y
+            if (base & 0xFF) + (index & 0xFF) > 0xFF:
+                extra += 1
+        # Every byte of the instruction is fetched at its region's speed; a
+        # fast access (6 master clocks) is what one table cycle assumes.
+        # Region boundaries fall on 4KB pages bar the joypad ports at $4000.
+        wait = self.wait_clocks + (mem.access_clocks(addr) - 6) * (size + 1)
+        self.wait_clocks = wait % 6
+        return extra + wait // 6
+        
+    def run_steps(self, count):
+        """Execute count instructions; returns the cycles they took"""
+        return self.run(count)
+    
+    def run_cycles(self, n):
+        """Execute instructions until at least n cycles have elapsed"""
+        return self.run(cycles=n)
+    
+    def run_until(self, event, limit=None):
+        """Execute until the PC reaches bus address event (without running
+        the instruction there) or limit cycles (RUN_UNTIL_LIMIT if None)
+        have elapsed"""
+        if limit is None:
+            limit = self.RUN_UNTIL_LIMIT
+        return self.run(cycles=limit, stop=event & 0xFFFFFF)
+    
+    def run(self, steps=-1, cycles=None, stop=-1):
+        """Execute up to steps instructions (-1: no limit) until at least
+        cycles cycles have elapsed or the PC reaches bus address stop;
+        returns the cycles used
+        
+        Either steps or cycles must bound the run. Same results as calling
+        step() in a loop, dispatching through the same CPU_OPERATIONS, but
+        registers live in locals and opcodes and operands are fetched
+        straight from the bus page table.
+        Registers are written back on exit and before every slow-path read,
+        so watchpoint callbacks see them as step() would leave them. Debugger
+        breakpoints and watch hits are raised from here as step() raises
+        them. With a profiler or trace hooked into step(), or with the
+        'accurate' timing profile, this just calls it. If a hook or the
+        debugger raises, steps_left holds the instructions not yet run.
+        """
+        if steps < 0 and cycles is None:
+            raise ValueError("run() needs a step or cycle limit")
+        start = self.cycles
+        end = start + cycles if cycles is not None else 1 << 62
+        if len(self.mem.rom) == 0:
+            return 0
+        if 'step' in self.__dict__ or self.profile != 'fast':
+            step = self.step
+            try:
+                while steps and self.cycles < end and ((self.pb << 16) | self.pc) != stop:
+                    before = self.cycles
+                    step()
+                    steps -= 1
+            except BaseException:
+                # A hook may raise once its instruction has run (a watchpoint
+                # hit); that one counts, so steps_left is what is still to run
+                if self.cycles != before:
+                    steps -= 1
+                self.steps_left = steps
+                raise
+            return self.cycles - start
+        
+        read_pages = self.mem.read_pages
+        read_slow = self.mem.read_slow
+        operations = CPU_OPERATIONS
+        debugger = self.debugger
+        breakpoints = debugger.breakpoints if debugger is not None else None
+        a, x, y, p, pc, pb = self.a, self.x, self.y, self.p, self.pc, self.pb
+        # Register widths only change with P in native mode
+        native = not self.e
+        costs, sizes = CYCLE_TABLES[4], OPERAND_SIZES[4]
+        count = start
+        try:
+            while steps and count < end:
+                base = pb << 16
+                addr = base | pc
+                if addr == stop:
+                    break
+                if debugger is not None:
+                    # before() in full only when it has something to do
+                    if (addr in breakpoints or debugger.pending is not None
+                            or debugger.resume_pc is not None):
+                        debugger.before(addr)
+                    debugger.instruction_pc = addr
+                steps -= 1
+                page = read_pages[addr >> 12]
+                if page is not None:
+                    opcode = page[addr & 0xFFF]
+                else:
+                    self.a, self.x, self.y, self.p, self.pc, self.cycles = a, x, y, p, pc, count
+                    opcode = read_slow(addr)
+                pc = (pc + 1) & 0xFFFF
+                if native:
+                    index = (p >> 4) & 3
+                    costs, sizes = CYCLE_TABLES[index], OPERAND_SIZES[index]
+                count += costs[opcode]
+                operation = operations[opcode]
+                size = sizes[opcode]
+                if operation is None:
+                    pc = (pc + size) & 0xFFFF
+                    continue
+                operand = 0
+                if size:
+                    addr = base | pc
+                    page = read_pages[addr >> 12]
+                    offset = addr & 0xFFF
+                    if page is not None and offset + size <= 0x1000:
+                        # Operand on the same page as the opcode: the usual case
+                        operand = page[offset]
+                        if size > 1:
+                            operand |= page[offset + 1] << 8
+                            if size > 2:
+                                operand |= page[offset + 2] << 16
+                        pc = (pc + size) & 0xFFFF
+                    else:
+                        for shift in range(0, size << 3, 8):
+                            addr = base | pc
+                            page = read_pages[addr >> 12]
+                            if page is not None:
+                                operand |= page[addr & 0xFFF] << shift
+                            else:
+                                self.a, self.x, self.y, self.p, self.pc, self.cycles = a, x, y, p, pc, count
+                                operand |= read_slow(addr) << shift
+                            pc = (pc + 1) & 0xFFFF
+                a, x, y, p, pc = operation(a, x, y, p, pc, operand)
+            if debugger is not None:
+                debugger.after()
+        except BaseException:
+            self.steps_left = steps
+            raise
+        finally:
+            self.a, self.x, self.y, self.p, self.pc, self.cycles = a, x, y, p, pc, count
+        return count - start
+    
+    def fetch_byte(self):
+        """Fetch byte at PC and increment"""
+        addr = (self.pb << 16) | self.pc
+        value = self.mem.read(addr)
+        self.pc = (self.pc + 1) & 0xFFFF
+        return value
+    
+    def execute_opcode(self, opcode):
+        """Execute opcode through CPU_OPERATIONS, fetching its operand"""
+        index = 4 if self.e else (self.p >> 4) & 3
+        self.cycles += CYCLE_TABLES[index][opcode]
+        operation = CPU_OPERATIONS[opcode]
+        if operation is None:
+            self.pc = (self.pc + OPERAND_SIZES[index][opcode]) & 0xFFFF
+            return
+        operand = 0
+        for shift in range(0, OPERAND_SIZES[index][opcode] << 3, 8):
+            operand |= self.fetch_byte() << shift
+        self.a, self.x, self.y, self.p, self.pc = operation(
+            self.a, self.x, self.y, self.p, self.pc, operand)
+            
+    def state_chunks(self):
+        """Registers and timing, including the bus's MEMSEL speed bit"""
+        return [self.STATE.pack(self.a, self.x, self.y, self.sp, self.pc, self.d,
+                                self.pb, self.db, self.p & 0xFF, self.e,
+                                self.wait_clocks, self.mem.memsel, self.cycles)]
+    
+    def load_state(self, view, offset):
+        (self.a, self.x, self.y, self.sp, self.pc, self.d,
+         self.pb, self.db, self.p, self.e,
+         self.wait_clocks, self.mem.memsel, self.cycles) = self.STATE.unpack_from(view, offset)
+        return offset + self.STATE.size
+
+# 65C816 opcode table: (mnemonic, addressing mode), indexed by opcode
+OPCODES = [tuple(entry.split()) if ' ' in entry else (entry, 'imp') for entry in (
+    'BRK imm8', 'ORA idpx', 'COP imm8', 'ORA sr', 'TSB dp', 'ORA dp', 'ASL dp', 'ORA ildp',
+    'PHP', 'ORA immm', 'ASL acc', 'PHD', 'TSB abs', 'ORA abs', 'ASL abs', 'ORA long',
+    'BPL rel', 'ORA idpy', 'ORA idp', 'ORA isry', 'TRB dp', 'ORA dpx', 'ASL dpx', 'ORA ildpy',
+    'CLC', 'ORA absy', 'INC acc', 'TCS', 'TRB abs', 'ORA absx', 'ASL absx', 'ORA longx',
+    'JSR abs', 'AND idpx', 'JSL long', 'AND sr', 'BIT dp', 'AND dp', 'ROL dp', 'AND ildp',
+    'PLP', 'AND immm', 'ROL acc', 'PLD', 'BIT abs', 'AND abs', 'ROL abs', 'AND long',
+    'BMI rel', 'AND idpy', 'AND idp', 'AND isry', 'BIT dpx', 'AND dpx', 'ROL dpx', 'AND ildpy',
+    'SEC', 'AND absy', 'DEC acc', 'TSC', 'BIT absx', 'AND absx', 'ROL absx', 'AND longx',
+    'RTI', 'EOR idpx', 'WDM imm8', 'EOR sr', 'MVP bm', 'EOR dp', 'LSR dp', 'EOR ildp',
+    'PHA', 'EOR immm', 'LSR acc', 'PHK', 'JMP abs', 'EOR abs', 'LSR abs', 'EOR long',
+    'BVC rel', 'EOR idpy', 'EOR idp', 'EOR isry', 'MVN bm', 'EOR dpx', 'LSR dpx', 'EOR ildpy',
+    'CLI', 'EOR absy', 'PHY', 'TCD', 'JML long', 'EOR absx', 'LSR absx', 'EOR longx',
+    'RTS', 'ADC idpx', 'PER rell', 'ADC sr', 'STZ dp', 'ADC dp', 'ROR dp', 'ADC ildp',
+    'PLA', 'ADC immm', 'ROR acc', 'RTL', 'JMP iabs', 'ADC abs', 'ROR abs', 'ADC long',
+    'BVS rel', 'ADC idpy', 'ADC idp', 'ADC isry', 'STZ dpx', 'ADC dpx', 'ROR dpx', 'ADC ildpy',
+    'SEI', 'ADC absy', 'PLY', 'TDC', 'JMP iabsx', 'ADC absx', 'ROR absx', 'ADC longx',
+    'BRA rel', 'STA idpx', 'BRL rell', 'STA sr', 'STY dp', 'STA dp', 'STX dp', 'STA ildp',
+    'DEY', 'BIT immm', 'TXA', 'PHB', 'STY abs', 'STA abs', 'STX abs', 'STA long',
+    'BCC rel', 'STA idpy', 'STA idp', 'STA isry', 'STY dpx', 'STA dpx', 'STX dpy', 'STA ildpy',
+    'TYA', 'STA absy', 'TXS', 'TXY', 'STZ abs', 'STA absx', 'STZ absx', 'STA longx',
+    'LDY immx', 'LDA idpx', 'LDX immx', 'LDA sr', 'LDY dp', 'LDA dp', 'LDX dp', 'LDA ildp',
+    'TAY', 'LDA immm', 'TAX', 'PLB', 'LDY abs', 'LDA abs', 'LDX abs', 'LDA long',
+    'BCS rel', 'LDA idpy', 'LDA idp', 'LDA isry', 'LDY dpx', 'LDA dpx', 'LDX dpy', 'LDA ildpy',
+    'CLV', 'LDA absy', 'TSX', 'TYX', 'LDY absx', 'LDA absx', 'LDX absy', 'LDA longx',
+    'CPY immx', 'CMP idpx', 'REP imm8', 'CMP sr', 'CPY dp', 'CMP dp', 'DEC dp', 'CMP ildp',
+    'INY', 'CMP immm', 'DEX', 'WAI', 'CPY abs', 'CMP abs', 'DEC abs', 'CMP long',
+    'BNE rel', 'CMP idpy', 'CMP idp', 'CMP isry', 'PEI idp', 'CMP dpx', 'DEC dpx', 'CMP ildpy',
+    'CLD', 'CMP absy', 'PHX', 'STP', 'JML ilabs', 'CMP absx', 'DEC absx', 'CMP longx',
+    'CPX immx', 'SBC idpx', 'SEP imm8', 'SBC sr', 'CPX dp', 'SBC dp', 'INC dp', 'SBC ildp',
+    'INX', 'SBC immm', 'NOP', 'XBA', 'CPX abs', 'SBC abs', 'INC abs', 'SBC long',
+    'BEQ rel', 'SBC idpy', 'SBC idp', 'SBC isry', 'PEA imm16', 'SBC dpx', 'INC dpx', 'SBC ildpy',
+    'SED', 'SBC absy', 'PLX', 'XCE', 'JSR iabsx', 'SBC absx', 'INC absx', 'SBC longx',
+)]
+
+# Addressing mode -> (operand bytes, operand format)
+ADDRESS_MODES = {
+    'imp': (0, ''), 'acc': (0, 'A'), 'imm8': (1, '#${:02X}'), 'imm16': (2, '${:04X}'),
+    'dp': (1, '${:02X}'), 'dpx': (1, '${:02X},X'), 'dpy': (1, '${:02X},Y'),
+    'idp': (1, '(${:02X})'), 'idpx': (1, '(${:02X},X)'), 'idpy': (1, '(${:02X}),Y'),
+    'ildp': (1, '[${:02X}]'), 'ildpy': (1, '[${:02X}],Y'),
+    'abs': (2, '${:04X}'), 'absx': (2, '${:04X},X'), 'absy': (2, '${:04X},Y'),
+    'iabs': (2, '(${:04X})'), 'iabsx': (2, '(${:04X},X)'), 'ilabs': (2, '[${:04X}]'),
+    'long': (3, '${:06X}'), 'longx': (3, '${:06X},X'),
+    'sr': (1, '${:02X},S'), 'isry': (1, '(${:02X},S),Y'),
+    'rel': (1, '${:04X}'), 'rell': (2, '${:04X}'), 'bm': (2, '${:02X},${:02X}'),
+}
+
+# Base cycle counts with 8-bit registers; 16-bit widths are added per table
+CYCLES_READ = {'immm': 2, 'immx': 2, 'dp': 3, 'dpx': 4, 'dpy': 4, 'idp': 5,
+               'idpx': 6, 'idpy': 5, 'ildp': 6, 'ildpy': 6, 'abs': 4, 'absx': 4,
+               'absy': 4, 'long': 5, 'longx': 5, 'sr': 4, 'isry': 7}
+CYCLES_STORE = dict(CYCLES_READ, absx=5, absy=5, idpy=6)
+CYCLES_RMW = {'acc': 2, 'dp': 5, 'dpx': 6, 'abs': 6, 'absx': 7}
+CYCLES_SPECIAL = {
+    'BRK': 7, 'COP': 7, 'RTI': 6, 'RTS': 6, 'RTL': 6, 'JSL': 8, 'BRA': 3, 'BRL': 4,
+    'JSR abs': 6, 'JSR iabsx': 8, 'JMP abs': 3, 'JMP iabs': 5, 'JMP iabsx': 6,
+    'JML long': 4, 'JML ilabs': 6, 'PHP': 3, 'PHA': 3, 'PHX': 3, 'PHY': 3, 'PHB': 3,
+    'PHK': 3, 'PHD': 4, 'PLP': 4, 'PLA': 4, 'PLX': 4, 'PLY': 4, 'PLB': 4, 'PLD': 5,
+    'PEA': 5, 'PEI': 6, 'PER': 6, 'REP': 3, 'SEP': 3, 'XBA': 3, 'WAI': 3, 'STP': 3,
+    'MVN': 7, 'MVP': 7,
+}
+M_WIDTH = {'ORA', 'AND', 'EOR', 'ADC', 'SBC', 'CMP', 'BIT', 'LDA', 'STA', 'STZ',
+           'TSB', 'TRB', 'ASL', 'LSR', 'ROL', 'ROR', 'INC', 'DEC', 'PHA', 'PLA'}
+X_WIDTH = {'LDX', 'LDY', 'CPX', 'CPY', 'STX', 'STY', 'PHX', 'PHY', 'PLX', 'PLY'}
+STORES = {'STA', 'STZ', 'STX', 'STY'}
+READ_MODIFY_WRITE = {'ASL', 'LSR', 'ROL', 'ROR', 'INC', 'DEC', 'TSB', 'TRB'}
+DP_MODES = {'dp', 'dpx', 'dpy', 'idp', 'idpx', 'idpy', 'ildp', 'ildpy'}
+
+def build_cycle_tables():
+    """Per-opcode cycle costs for each register width, indexed by
+    4 if emulation mode else (P >> 4) & 3, i.e. M and X as bits 1 and 0"""
+    tables = []
+    for index in range(5):
+        emulation = index == 4
+        m16 = not emulation and not index & 2
+        x16 = not emulation and not index & 1
+        table = bytearray(256)
+        for opcode, (mnemonic, mode) in enumerate(OPCODES):
+            if f"{mnemonic} {mode}" in CYCLES_SPECIAL:
+                cycles = CYCLES_SPECIAL[f"{mnemonic} {mode}"]
+            elif mnemonic in CYCLES_SPECIAL:
+                cycles = CYCLES_SPECIAL[mnemonic]
+                if mnemonic in ('BRK', 'COP', 'RTI') and not emulation:
+                    cycles += 1  # native mode also pushes/pulls the bank
+            elif mode == 'rel':
+                cycles = 2  # +1 when taken
+            elif mnemonic in READ_MODIFY_WRITE and mode in CYCLES_RMW:
+                cycles = CYCLES_RMW[mode] + (2 if m16 and mode != 'acc' else 0)
+                table[opcode] = cycles
+                continue
+            elif mode in CYCLES_READ:
+                cycles = (CYCLES_STORE if mnemonic in STORES else CYCLES_READ)[mode]
+                # 16-bit index registers always pay the indexing cycle
+                if x16 and mode in ('absx', 'absy', 'idpy') and mnemonic not in STORES:
+                    cycles += 1
+            else:
+                cycles = 2
+            if (m16 and mnemonic in M_WIDTH) or (x16 and mnemonic in X_WIDTH):
+                cycles += 1
+            table[opcode] = cycles
+        tables.append(bytes(table))
+    return tables
+
+CYCLE_TABLES = build_cycle_tables()
+
+# Accurate-profile opcode facts: (operand bytes, or -1/-2 for M/X-sized
+# immediates; direct page mode; indexed read mode that can cross a page)
+OPCODE_TIMING = [
+    ({'immm': -1, 'immx': -2}.get(mode, ADDRESS_MODES.get(mode, (0,))[0]),
+     mode in DP_MODES,
+     mode if mode in ('absx', 'absy', 'idpy') and mnemonic not in STORES
+     and mnemonic not in READ_MODIFY_WRITE else None)
+    for mnemonic, mode in OPCODES
+]
+CPU_TIMING_PROFILES = ('fast', 'accurate')
+
+def build_operand_sizes():
+    """Operand bytes per opcode for each register width, indexed like
+    CYCLE_TABLES"""
+    tables = []
+    for index in range(5):
+        m16 = index != 4 and not index & 2
+        x16 = index != 4 and not index & 1
+        tables.append(bytes(size if size >= 0 else 2 if (m16 if size == -1 else x16) else 1
+                            for size, _, _ in OPCODE_TIMING))
+    return tables
+
+OPERAND_SIZES = build_operand_sizes()
+
+def nz_flags(p, value, narrow):
+    """P with N and Z set from an 8-bit value if narrow, else a 16-bit one"""
+    sign = 0x80 if narrow else 0x8000
+    return (p & ~0x82) | (0x80 if value & sign else 0) | (0 if value else 0x02)
+
+# Implemented opcodes. A handler takes the registers and the operand (its
+# OPERAND_SIZES bytes, little-endian) and returns the registers; step() and
+# the batched run() loop both dispatch through this table. An opcode with no
+# handler costs its cycles and steps over its operand, all NOP ($EA) does.
+def op_clc(a, x, y, p, pc, operand):
+    return a, x, y, p & ~0x01, pc
+
+def op_sec(a, x, y, p, pc, operand):
+    return a, x, y, p | 0x01, pc
+
+def op_lda_immediate(a, x, y, p, pc, operand):
+    narrow = p & 0x20  # 8-bit A keeps its high byte
+    a = (a & 0xFF00) | operand if narrow else operand
+    return a, x, y, nz_flags(p, operand, narrow), pc
+
+def op_ldx_immediate(a, x, y, p, pc, operand):
+    return a, operand, y, nz_flags(p, operand, p & 0x10), pc
+
+def op_ldy_immediate(a, x, y, p, pc, operand):
+    return a, x, operand, nz_flags(p, operand, p & 0x10), pc
+
+def op_jmp_absolute(a, x, y, p, pc, operand):
+    return a, x, y, p, operand
+
+CPU_OPERATIONS = [None] * 256
+CPU_OPERATIONS[0x18] = op_clc
+CPU_OPERATIONS[0x38] = op_sec
+CPU_OPERATIONS[0xA9] = op_lda_immediate
+CPU_OPERATIONS[0xA2] = op_ldx_immediate
+CPU_OPERATIONS[0xA0] = op_ldy_immediate
+CPU_OPERATIONS[0x4C] = op_jmp_absolute
+
+def disassemble(memory, addr, m_flag=True, x_flag=True):
+    """Decode the instruction at a 24-bit address
+    
+    m_flag/x_flag are true for 8-bit accumulator/index registers; they
+    decide the width of immediate operands. Returns (text, length).
+    Bytes are peeked, so I/O registers and watchpoints are never touched.
+    """
+    bank = addr & 0xFF0000
+    pc = addr & 0xFFFF
+    mnemonic, mode = OPCODES[memory.peek(addr)]
+    if mode == 'immm':
+        size, fmt = (1, '#${:02X}') if m_flag else (2, '#${:04X}')
+    elif mode == 'immx':
+        size, fmt = (1, '#${:02X}') if x_flag else (2, '#${:04X}')
+    else:
+        size, fmt = ADDRESS_MODES[mode]
+    operand = 0
+    for i in range(size):
+        operand |= memory.peek(bank | ((pc + 1 + i) & 0xFFFF)) << (8 * i)
+    if mode == 'rel':
+        operand = (pc + 2 + (operand - 0x100 if operand & 0x80 else operand)) & 0xFFFF
+    elif mode == 'rell':
+        operand = (pc + 3 + operand) & 0xFFFF
+    if mode == 'bm':
+        text = fmt.format(operand >> 8, operand & 0xFF)  # source, destination
+    else:
+        text = fmt.format(operand)
+    return (f"{mnemonic} {text}" if text else mnemonic), size + 1
+
+class DisassemblyCache:
+    """Decoded instructions keyed by (home address, m, x)
+    
+    Lines are keyed by Memory.home, so a low RAM mirror shares its lines
+    with $7E0000-$7E1FFF. Writable pages holding cached lines get a write
+    watch on every bus page that mirrors them; the first store drops the
+    page's lines (and the watches), so code in ROM costs nothing and
+    self-modifying code in RAM is re-decoded. Wholesale changes (ROM load,
+    cheats, savestate load, power-on, reset) bump Memory.generation, which
+    empties the cache.
+    """
+    def __init__(self, memory):
+        self.memory = memory
+        self.generation = memory.generation
+        self.lines = {}    # (home, m_flag, x_flag) -> (text, length)
+        self.pages = {}    # home page -> keys of lines overlapping it
+        self.watched = {}  # home page -> watchpoints on it and its mirrors
+        
+    def get(self, addr, m_flag=True, x_flag=True):
+        memory = self.memory
+        if memory.generation != self.generation:
+            self.clear()
+        home = memory.home(addr)
+        key = (home, m_flag, x_flag)
+        line = self.lines.get(key)
+        if line is None:
+            line = disassemble(memory, addr, m_flag, x_flag)
+            self.lines[key] = line
+            last = memory.home((addr & 0xFF0000) | ((addr + line[1] - 1) & 0xFFFF))
+            for page in {home >> 12, last >> 12}:
+                self.pages.setdefault(page, set()).add(key)
+                if page not in self.watched and memory.write_backing[page] is not None:
+                    self.watched[page] = memory.watch_pages(
+                        memory.mirror_pages(page), self.on_write, read=False, write=True)
+        return line
+    
+    def on_write(self, kind, addr, value):
+        page = self.memory.home(addr) >> 12
+        for key in self.pages.pop(page, ()):
+            self.lines.pop(key, None)
+        watchpoints = self.watched.pop(page, None)
+        if watchpoints is not None:
+            self.memory.unwatch(*watchpoints)
+            
+    def clear(self):
+        watchpoints = [w for page in self.watched.values() for w in page]
+        if watchpoints:
+            self.memory.unwatch(*watchpoints)
+        self.lines.clear()
+        self.pages.clear()
+        self.watched.clear()
+        self.generation = self.memory.generation
+
+def add_hook(owner, name, wrap):
+    """Shadow owner.name on the instance with wrap(current owner.name)
+    
+    Hooks stack: each is kept in owner.hooks, innermost first, so any one
+    can be removed while others stay installed.
+    """
+    owner.hooks.setdefault(name, []).append(wrap)
+    setattr(owner, name, wrap(getattr(owner, name)))
+
+def remove_hook(owner, name, wrap):
+    """Undo add_hook: rebuild the remaining hooks over the class's own
+    method, which is back on the fast path once no hook is left"""
+    chain = owner.hooks.get(name, [])
+    if wrap not in chain:
+        return
+    chain.remove(wrap)
+    owner.__dict__.pop(name, None)
+    for hook in chain:
+        setattr(owner, name, hook(getattr(owner, name)))
+    if not chain:
+        del owner.hooks[name]
+
+class CPUProfiler:
+    """Execution and cycle counters per opcode and per 24-bit PC
+    
+    start() hooks a counting wrapper into cpu.step (see add_hook) and
+    stop() removes it, so the class's own step is the only dispatch path
+    while profiling is off. PC counters are allocated one bank at a time.
+    """
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.opcode_counts = array('Q', bytes(8 * 256))
+        self.opcode_cycles = array('Q', bytes(8 * 256))
+        self.pc_counts = [None] * 256   # bank -> array('Q', 65536)
+        self.pc_cycles = [None] * 256
+        
+    def start(self):
+        add_hook(self.cpu, 'step', self.wrap_step)
+        
+    def stop(self):
+        remove_hook(self.cpu, 'step', self.wrap_step)
+        
+    def wrap_step(self, inner):
+        cpu = self.cpu
+        peek = cpu.mem.peek
+        opcode_counts = self.opcode_counts
+        opcode_cycles = self.opcode_cycles
+        pc_counts = self.pc_counts
+        pc_cycles = self.pc_cycles
+        
+        def step():
+            pb = cpu.pb
+            pc = cpu.pc
+            # Peeked before it runs: no I/O side effects or watch hits, and
+            # self-modifying code is charged to the opcode that executed
+            opcode = peek((pb << 16) | pc)
+            before = cpu.cycles
+            inner()
+            spent = cpu.cycles - before
+            if not spent:
+                return
+            opcode_counts[opcode] += 1
+            opcode_cycles[opcode] += spent
+            counts = pc_counts[pb]
+            if counts is None:
+                counts = pc_counts[pb] = array('Q', bytes(8 * 0x10000))
+                pc_cycles[pb] = array('Q', bytes(8 * 0x10000))
+            counts[pc] += 1
+            pc_cycles[pb][pc] += spent
+        
+        return step
+    
+    def report(self, top=20):
+        """Ranked text report of the hottest opcodes and PCs"""
+        cpu = self.cpu
+        total = sum(self.opcode_cycles) or 1
+        lines = ["Opcode  Mnemonic      Count      Cycles   %Cyc"]
+        ranked = sorted(range(256), key=lambda op: self.opcode_cycles[op], reverse=True)
+        for op in ranked[:top]:
+            if not self.opcode_counts[op]:
+                break
+            mnemonic, mode = OPCODES[op]
+            lines.append(f"  ${op:02X}   {mnemonic} {mode:6} {self.opcode_counts[op]:10} "
+                         f"{self.opcode_cycles[op]:11} {100 * self.opcode_cycles[op] / total:6.2f}")
+        
+        hot = []
+        for bank, cycles in enumerate(self.pc_cycles):
+            if cycles is None:
+                continue
+            values = np.frombuffer(cycles, np.uint64)
+            for pc in np.argsort(values)[::-1][:top]:
+                if values[pc]:
+                    hot.append((int(values[pc]), (bank << 16) | int(pc)))
+        hot.sort(reverse=True)
+        
+        m_flag = bool(cpu.e or cpu.p & 0x20)
+        x_flag = bool(cpu.e or cpu.p & 0x10)
+        lines.append("")
+        lines.append("PC        Count      Cycles   %Cyc  Disassembly")
+        for cycles, addr in hot[:top]:
+            count = self.pc_counts[addr >> 16][addr & 0xFFFF]
+            text, _ = disassemble(cpu.mem, addr, m_flag, x_flag)
+            lines.append(f"${addr:06X} {count:9} {cycles:11} {100 * cycles / total:6.2f}  {text}")
+        return "\n".join(lines)
+
+# Execution trace file: header, then fixed-size records
+TRACE_MAGIC = b'ZMZT'
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct('<4sHH')
+# pc24, A, X, Y, SP, opcode, P, DB, cycle counter before the instruction
+TRACE_RECORD = struct.Struct('<IHHHHBBBxQ')
+
+class MemoryHeatmap:
+    """Read, write and execute counters per 256-byte page of the 24-bit bus
+    
+    Like CPUProfiler, start() hooks counting wrappers into memory.read/write
+    and cpu.step and stop() removes them, so nothing
+    is counted (or slowed) while the heatmap is off. Reads include opcode
+    and operand fetches; executes count instructions by the page of their
+    first byte.
+    """
+    PAGES = 0x10000
+    KINDS = ('read', 'write', 'exec')
+    
+    def __init__(self, memory, cpu):
+        self.memory = memory
+        self.cpu = cpu
+        self.counts = {kind: array('Q', bytes(8 * self.PAGES)) for kind in self.KINDS}
+        self.running = False
+        
+    def start(self):
+        if self.running:
+            return
+        add_hook(self.memory, 'read', self.wrap_read)
+        add_hook(self.memory, 'write', self.wrap_write)
+        add_hook(self.cpu, 'step', self.wrap_step)
+        self.running = True
+        
+    def stop(self):
+        if not self.running:
+            return
+        remove_hook(self.memory, 'read', self.wrap_read)
+        remove_hook(self.memory, 'write', self.wrap_write)
+        remove_hook(self.cpu, 'step', self.wrap_step)
+        self.running = False
+        
+    def wrap_read(self, inner):
+        reads = self.counts['read']
+        
+        def read(addr):
+            reads[(addr >> 8) & 0xFFFF] += 1
+            return inner(addr)
+        return read
+    
+    def wrap_write(self, inner):
+        writes = self.counts['write']
+        
+        def write(addr, value):
+            writes[(addr >> 8) & 0xFFFF] += 1
+            inner(addr, value)
+        return write
+    
+    def wrap_step(self, inner):
+        cpu = self.cpu
+        execs = self.counts['exec']
+        
+        def step():
+            execs[(cpu.pb << 8) | (cpu.pc >> 8)] += 1
+            inner()
+        return step
+    
+    def clear(self):
+        for counts in self.counts.values():
+            counts[:] = array('Q', bytes(8 * self.PAGES))
+    
+    def export_csv(self, path):
+        """Write one row per touched page: address and the three counts"""
+        reads, writes, execs = (self.counts[kind] for kind in self.KINDS)
+        with open(path, 'w', newline='') as f:
+            f.write("page,reads,writes,executes\n")
+            for page in range(self.PAGES):
+                if reads[page] or writes[page] or execs[page]:
+                    f.write(f"${page << 8:06X},{reads[page]},{writes[page]},{execs[page]}\n")
+    
+    def image(self):
+        """256x256 PPM with one pixel per page: bank down, page across;
+        red is writes, green reads and blue executes, each log-scaled"""
+        channels = []
+        for kind in ('write', 'read', 'exec'):
+            counts = np.log1p(np.frombuffer(self.counts[kind], np.uint64))
+            peak = counts.max()
+            channels.append(counts * (255 / peak) if peak else counts)
+        pixels = np.stack(channels, axis=1).astype(np.uint8)
+        return b"P6 256 256 255 " + pixels.tobytes()
+
+class ExecutionTrace:
+    """Per-instruction binary trace kept in a preallocated ring buffer
+    
+    Each step packs one TRACE_RECORD into the ring; nothing is formatted
+    until decode_trace runs offline. With a path the ring is spilled to
+    disk whenever it fills, otherwise it keeps the last `capacity` records
+    until flush() is called.
+    """
+    def __init__(self, cpu, capacity=1 << 16, path=None):
+        self.cpu = cpu
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * TRACE_RECORD.size)
+        self.count = 0  # records written since the last spill
+        self.path = path
+        self.file = None
+        
+    def start(self):
+        add_hook(self.cpu, 'step', self.wrap_step)
+        
+    def stop(self):
+        remove_hook(self.cpu, 'step', self.wrap_step)
+        if self.path:
+            self.flush()
+            
+    def wrap_step(self, inner):
+        cpu = self.cpu
+        peek = cpu.mem.peek
+        pack_into = TRACE_RECORD.pack_into
+        size = TRACE_RECORD.size
+        buffer = self.buffer
+        end = len(buffer)
+        
+        def step():
+            pos = (self.count % self.capacity) * size
+            before = cpu.cycles
+            pc = (cpu.pb << 16) | cpu.pc
+            pack_into(buffer, pos, pc, cpu.a, cpu.x, cpu.y, cpu.sp,
+                      peek(pc), cpu.p & 0xFF, cpu.db, before)
+            inner()
+            if cpu.cycles != before:
+                self.count += 1
+                if self.path and pos + size == end:
+                    self.spill()
+        
+        return step
+    
+    def records(self):
+        """Buffered records, oldest first, as up to two memoryviews"""
+        view = memoryview(self.buffer)
+        size = TRACE_RECORD.size
+        if self.count <= self.capacity:
+            return [view[:self.count * size]]
+        split = (self.count % self.capacity) * size
+        return [view[split:], view[:split]]
+    
+    def flush(self, path=None):
+        """Write buffered records to path (or the spill file) in one go"""
+        if path is None and not self.path:
+            raise ValueError("Trace has no spill file; pass a path to flush to")
+        if path is not None:
+            with open(path, 'wb') as f:
+                f.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size))
+                for chunk in self.records():
+                    f.write(chunk)
+            return
+        self.spill()
+        self.file.close()
+        self.file = None
+        
+    def spill(self):
+        if self.file is None:
+            self.file = open(self.path, 'wb')
+            self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size))
+        for chunk in self.records():
+            self.file.write(chunk)
+        self.count = 0
+
+def decode_trace(path):
+    """Yield one text line per record of a trace file"""
+    with open(path, 'rb') as f:
+        magic, version, size = TRACE_HEADER.unpack(f.read(TRACE_HEADER.size))
+        if magic != TRACE_MAGIC:
+            raise ValueError("Not a trace file")
+        if version != TRACE_VERSION or size != TRACE_RECORD.size:
+            raise ValueError(f"Unsupported trace version {version}")
+        while True:
+            chunk = f.read(size * 4096)
+            if not chunk:
+                break
+            for pc, a, x, y, sp, opcode, p, db, cycles in TRACE_RECORD.iter_unpack(chunk):
+                yield (f"${pc:06X}  {opcode:02X} {OPCODES[opcode][0]}  A:{a:04X} X:{x:04X} "
+                       f"Y:{y:04X} S:{sp:04X} P:{p:02X} DB:{db:02X} CYC:{cycles}")
+
+class BreakpointHit(Exception):
+    """Raised out of the emulation loop when a breakpoint or watchpoint fires"""
+    def __init__(self, kind, addr, value=None, pc=None):
+        self.kind = kind    # 'exec', 'read' or 'write'
+        self.addr = addr
+        self.value = value
+        self.pc = addr if pc is None else pc
+        if kind == 'exec':
+            message = f"Breakpoint at ${addr:06X}"
+        else:
+            message = f"{kind.title()} ${addr:06X} = ${value:02X} at PC ${self.pc:06X}"
+        super().__init__(message)
+
+class Debugger:
+    """PC breakpoints and memory watchpoints
+    
+    Watchpoints only take the bus pages they cover off the fast path (see
+    Memory.watch). While anything is set the CPU calls before() and after()
+    around each instruction, in step() and in its batched run() loop alike:
+    before() checks the PC set, and a watch hit is raised once the current
+    instruction has finished, so it never leaves the CPU mid-instruction.
+    """
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.breakpoints = set()
+        self.watchpoints = []
+        self.pending = None
+        self.instruction_pc = 0
+        self.resume_pc = None
+        self.enabled = True  # cleared while frames that will be discarded run
+        
+    def add_breakpoint(self, addr):
+        self.breakpoints.add(addr & 0xFFFFFF)
+        self.update()
+        
+    def remove_breakpoint(self, addr):
+        self.breakpoints.discard(addr & 0xFFFFFF)
+        self.update()
+        
+    def add_watchpoint(self, start, end=None, read=True, write=True):
+        """Watch start..end (inclusive); returns a handle for removal"""
+        watchpoint = self.cpu.mem.watch(start, start if end is None else end,
+                                        self.on_access, read, write)
+        self.watchpoints.append(watchpoint)
+        self.update()
+        return watchpoint
+    
+    def remove_watchpoint(self, watchpoint):
+        self.watchpoints.remove(watchpoint)
+        self.cpu.mem.unwatch(watchpoint)
+        self.update()
+        
+    def on_access(self, kind, addr, value):
+        if self.pending is None and self.enabled:
+            self.pending = BreakpointHit(kind, addr, value, self.instruction_pc)
+    
+    def resume(self):
+        """Let the instruction at the current PC run past its breakpoint"""
+        self.resume_pc = (self.cpu.pb << 16) | self.cpu.pc
+        self.pending = None
+        
+    def update(self):
+        active = bool(self.breakpoints or self.watchpoints)
+        self.cpu.debugger = self if active else None
+    
+    def before(self, pc):
+        """Raise the watch hit still pending from the last instruction, or
+        a breakpoint at pc, the next instruction to run"""
+        self.after()
+        if not self.enabled:
+            return
+        if pc in self.breakpoints and pc != self.resume_pc:
+            raise BreakpointHit('exec', pc)
+        self.resume_pc = None
+        self.instruction_pc = pc
+    
+    def after(self):
+        """Raise the watch hit the instruction just run caused, if any"""
+        if self.pending is not None:
+            hit = self.pending
+            self.pending = None
+            raise hit
+
+class PPU:
+    """Picture Processing Unit - Graphics"""
+    STATE = struct.Struct('<HBB')
+    
+    def __init__(self, memory):
+        self.mem = memory
+        self.scanline = 0
+        self.frame_buffer = bytearray(256 * 224 * 3)  # RGB
+        self.bg_mode = 0
+        self.brightness = 15
+        
+    def render_scanline(self):
+        """Render one scanline"""
+        if self.scanline >= 224:
+            return
+        
+        # Simple gradient pattern when no ROM loaded
+        offset = self.scanline * 256 * 3
+        for x in range(256):
+            idx = offset + x * 3
+            self.frame_buffer[idx] = (x + self.scanline) % 256      # R
+            self.frame_buffer[idx + 1] = (x * 2) % 256              # G
+            self.frame_buffer[idx + 2] = (self.scanline * 2) % 256  # B
+    
+    def step(self, render=True):
+        """Process one PPU cycle"""
+        if render:
+            self.render_scanline()
+        self.scanline = (self.scanline + 1) % 262
+    
+    def state_chunks(self):
+        return [self.STATE.pack(self.scanline, self.bg_mode, self.brightness)]
+    
+    def load_state(self, view, offset):
+        self.scanline, self.bg_mode, self.brightness = self.STATE.unpack_from(view, offset)
+        return offset + self.STATE.size
+
+# S-DSP envelope counter periods (samples per step), indexed by 5-bit rate
+ENVELOPE_RATES = (0, 2048, 1536, 1280, 1024, 768, 640, 512, 384, 320, 256,
+                  192, 160, 128, 96, 80, 64, 48, 40, 32, 24, 20, 16, 12, 10,
+                  8, 6, 5, 4, 3, 2, 1)
+
+class BRRCache:
+    """Decoded BRR sample chains keyed by the ARAM address of their first block"""
+    def __init__(self, aram):
+        self.aram = aram
+        self.entries = {}  # (start, loop) -> (samples, loop_index)
+        self.pages = {}    # ARAM page -> keys of entries decoded from it
+        
+    def get(self, start, loop):
+        """Return (samples, loop_index) for a source, decoding on a miss"""
+        key = (start, loop)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.decode(start, loop)
+            self.entries[key] = entry
+        return entry
+    
+    def invalidate(self, addr, length=1):
+        """Drop every entry decoded from ARAM[addr:addr+length]"""
+        for page in range(addr >> 8, ((addr + length - 1) >> 8) + 1):
+            keys = self.pages.pop(page & 0xFF, None)
+            if keys:
+                for key in keys:
+                    self.entries.pop(key, None)
+    
+    def decode(self, start, loop):
+        """Decode blocks from start until an END block, following its loop"""
+        key = (start, loop)
+        chunks = []
+        block_index = {}  # block address -> first sample index
+        history = [0, 0]
+        addr = start
+        loop_index = None
+        count = 0
+        while count < 0x2000:
+            block_index[addr] = count * 16
+            header = self.decode_block(addr, history, chunks)
+            for page in (addr >> 8, ((addr + 8) >> 8) & 0xFF):
+                self.pages.setdefault(page, set()).add(key)
+            count += 1
+            addr = (addr + 9) & 0xFFFF
+            if header & 0x01:  # END
+                if not header & 0x02:  # no LOOP: voice stops here
+                    break
+                if loop in block_index:
+                    loop_index = block_index[loop]
+                    break
+                addr = loop
+        samples = np.concatenate(chunks) if chunks else np.zeros(16, np.int32)
+        return samples, loop_index
+    
+    def decode_block(self, addr, history, chunks):
+        """Decode one 9-byte block into chunks, returning its header byte"""
+        aram = self.aram
+        header = aram[addr]
+        data = np.array([aram[(addr + i) & 0xFFFF] for i in range(1, 9)], np.int32)
+        nibbles = np.empty(16, np.int32)
+        nibbles[0::2] = data >> 4
+        nibbles[1::2] = data & 0x0F
+        nibbles = (nibbles ^ 8) - 8
+        shift = header >> 4
+        if shift <= 12:
+            raw = (nibbles << shift) >> 1
+        else:
+            raw = np.where(nibbles < 0, -2048, 0)
+        
+        filt = (header >> 2) & 3
+        if filt == 0:
+            out = raw
+        else:
+            # Prediction filters depend on the previous two outputs
+            p1, p2 = history
+            out = np.empty(16, np.int32)
+            for i, s in enumerate(raw.tolist()):
+                if filt == 1:
+                    s += p1 + ((-p1) >> 4)
+                elif filt == 2:
+                    s += (p1 << 1) + ((-p1 * 3) >> 5) - p2 + (p2 >> 4)
+                else:
+                    s += (p1 << 1) + ((-p1 * 13) >> 6) - p2 + ((p2 * 3) >> 4)
+                s = max(-32768, min(32767, s))
+                out[i] = s
+                p2, p1 = p1, s
+        history[0] = int(out[15])
+        history[1] = int(out[14])
+        chunks.append(out)
+        return header
+
+class DSPVoice:
+    """State of one S-DSP voice"""
+    def __init__(self):
+        self.samples = None
+        self.loop_index = None
+        self.pos = 0.0
+        self.env = 0
+        self.env_phase = 'release'
+        self.env_counter = 0
+        self.active = False
+
+class DSP:
+    """S-DSP - mixes 8 BRR voices a block of samples at a time"""
+    def __init__(self, aram):
+        self.aram = aram
+        self.aram16 = np.frombuffer(aram, dtype='<i2')  # echo buffer view
+        self.regs = bytearray(128)
+        self.voices = [DSPVoice() for _ in range(8)]
+        self.brr = BRRCache(aram)
+        self.echo_pos = 0
+        self.fir_history = np.zeros((7, 2), np.int64)
+        self.regs[0x6C] = 0xE0  # FLG: soft reset, mute, echo writes off
+        
+    def read(self, reg):
+        return self.regs[reg & 0x7F]
+    
+    def write(self, reg, value):
+        reg &= 0x7F
+        value &= 0xFF
+        self.regs[reg] = value
+        if reg == 0x4C:
+            self.key_on(value)
+        elif reg == 0x5C:
+            for v in range(8):
+                if value & (1 << v):
+                    self.voices[v].env_phase = 'release'
+        elif reg == 0x7C:
+            self.regs[0x7C] = 0  # any write clears ENDX
+    
+    def key_on(self, mask):
+        """Start voices in mask from their directory entries"""
+        aram = self.aram
+        directory = self.regs[0x5D] << 8
+        for v in range(8):
+            if not mask & (1 << v):
+                continue
+            entry = (directory + self.regs[(v << 4) | 0x04] * 4) & 0xFFFF
+            start = aram[entry] | (aram[(entry + 1) & 0xFFFF] << 8)
+            loop = aram[(entry + 2) & 0xFFFF] | (aram[(entry + 3) & 0xFFFF] << 8)
+            voice = self.voices[v]
+            voice.samples, voice.loop_index = self.brr.get(start, loop)
+            voice.pos = 0.0
+            voice.env = 0
+            voice.env_counter = 0
+            voice.env_phase = 'attack'
+            voice.active = True
+            self.regs[0x7C] &= ~(1 << v) & 0xFF
+    
+    def envelope_mode(self, voice, base):
+        """Return (kind, step, rate, limit) for the voice's current phase"""
+        regs = self.regs
+        phase = voice.env_phase
+        if phase == 'release':
+            return 'linear', -8, 31, 0
+        adsr1 = regs[base | 0x05]
+        if adsr1 & 0x80:
+            adsr2 = regs[base | 0x06]
+            if phase == 'attack':
+                attack = adsr1 & 0x0F
+                if attack == 0x0F:
+                    return 'linear', 1024, 31, 0x7E0
+                return 'linear', 32, attack * 2 + 1, 0x7E0
+            if phase == 'decay':
+                sustain_level = ((adsr2 >> 5) + 1) << 8
+                return 'exp', 0, ((adsr1 >> 4) & 0x07) * 2 + 16, sustain_level
+            return 'exp', 0, adsr2 & 0x1F, 0
+        gain = regs[base | 0x07]
+        if not gain & 0x80:
+            return 'direct', (gain & 0x7F) << 4, 0, 0
+        mode = (gain >> 5) & 3
+        rate = gain & 0x1F
+        if mode == 0:
+            return 'linear', -32, rate, 0
+        if mode == 1:
+            return 'exp', 0, rate, 0
+        if mode == 2:
+            return 'linear', 32, rate, 0x7FF
+        return 'bent', 32, rate, 0x7FF
+    
+    def advance_envelope(self, voice, base, n):
+        """Advance a voice envelope n samples in closed form per phase"""
+        remaining = n
+        while remaining > 0:
+            kind, step, rate, limit = self.envelope_mode(voice, base)
+            if kind == 'direct':
+                voice.env = step
+                return
+            period = ENVELOPE_RATES[rate]
+            if period == 0:
+                return
+            env = voice.env
+            adsr = self.regs[base | 0x05] & 0x80 and voice.env_phase != 'release'
+            if adsr and voice.env_phase == 'decay' and env <= limit:
+                voice.env_phase = 'sustain'
+                continue
+            steps = (voice.env_counter + remaining) // period
+            # Steps until this phase hands over to the next one
+            if adsr and voice.env_phase == 'attack':
+                needed = max(1, -(-(limit - env) // step))
+            elif adsr and voice.env_phase == 'decay':
+                needed = max(1, math.ceil(math.log(limit / env) / math.log(255 / 256)))
+            else:
+                needed = None
+            if needed is not None and needed <= steps:
+                used = needed * period - voice.env_counter
+                steps = needed
+                voice.env_counter = 0
+                remaining -= used
+            else:
+                voice.env_counter = (voice.env_counter + remaining) % period
+                remaining = 0
+            
+            if kind == 'linear':
+                env += step * steps
+            elif kind == 'exp':
+                env = int(env * (255 / 256) ** steps)
+            else:  # bent: +32 up to 0x600, +8 above
+                below = max(0, min(steps, -(-(0x600 - env) // 32)))
+                env += below * 32 + (steps - below) * 8
+            voice.env = max(0, min(0x7FF, env))
+            
+            if needed is not None and needed == steps:
+                voice.env_phase = 'decay' if voice.env_phase == 'attack' else 'sustain'
+            elif voice.env_phase == 'release' and voice.env == 0:
+                voice.active = False
+                return
+    
+    def generate(self, n):
+        """Mix n stereo samples; returns an (n, 2) int16 array"""
+        regs = self.regs
+        main = np.zeros((n, 2), np.int64)
+        echo_in = np.zeros((n, 2), np.int64)
+        flg = regs[0x6C]
+        if flg & 0x80:  # soft reset silences every voice
+            for voice in self.voices:
+                voice.active = False
+                voice.env = 0
+        pmon = regs[0x2D]
+        eon = regs[0x4D]
+        prev_out = None
+        for v, voice in enumerate(self.voices):
+            if not voice.active:
+                prev_out = None
+                continue
+            base = v << 4
+            pitch = (regs[base | 0x02] | (regs[base | 0x03] << 8)) & 0x3FFF
+            if pmon & (1 << v) and v > 0 and prev_out is not None:
+                # Pitch modulation by the previous voice's output
+                steps = (pitch + (((prev_out >> 5) * pitch) >> 10)) / 4096.0
+                positions = voice.pos + np.concatenate(([0.0], np.cumsum(steps)[:-1]))
+                end = voice.pos + float(steps.sum())
+            else:
+                step = pitch / 4096.0
+                positions = voice.pos + np.arange(n) * step
+                end = voice.pos + n * step
+            
+            samples = voice.samples
+            length = len(samples)
+            loop = voice.loop_index
+            index = positions.astype(np.int64)
+            frac = positions - index
+            nxt = index + 1
+            if loop is None:
+                audible = index < length
+                index = np.minimum(index, length - 1)
+                nxt = np.minimum(nxt, length - 1)
+            else:
+                span = length - loop
+                index = np.where(index < length, index, loop + (index - loop) % span)
+                nxt = np.where(nxt < length, nxt, loop + (nxt - loop) % span)
+            s0 = samples[index]
+            wave = (s0 + (samples[nxt] - s0) * frac).astype(np.int64)
+            if loop is None:
+                wave *= audible
+            
+            env_start = voice.env
+            self.advance_envelope(voice, base, n)
+            env = env_start + ((voice.env - env_start) * np.arange(n)) // n
+            out = (wave * env) >> 11
+            prev_out = out
+            
+            if end >= length:
+                regs[0x7C] |= 1 << v
+                if loop is None:
+                    voice.active = False
+                    voice.env = 0
+                else:
+                    end = loop + (end - loop) % (length - loop)
+            voice.pos = end
+            
+            vol = np.array([self.signed(regs[base]), self.signed(regs[base | 0x01])])
+            mixed = (out[:, None] * vol) >> 7
+            main += mixed
+            if eon & (1 << v):
+                echo_in += mixed
+            regs[base | 0x08] = voice.env >> 4
+            regs[base | 0x09] = (int(out[-1]) >> 8) & 0xFF
+        
+        mvol = np.array([self.signed(regs[0x0C]), self.signed(regs[0x1C])])
+        main = (main * mvol) >> 7
+        main += self.echo(echo_in, flg)
+        if flg & 0x40:  # mute
+            main[:] = 0
+        return np.clip(main, -32768, 32767).astype(np.int16)
+    
+    def echo(self, echo_in, flg):
+        """Run the echo ring buffer and 8-tap FIR over a block"""
+        regs = self.regs
+        n = len(echo_in)
+        delay = max(1, (regs[0x7D] & 0x0F) * 512)  # stereo frames
+        esa = regs[0x6D] << 8
+        coef = np.array([self.signed(regs[(i << 4) | 0x0F]) for i in range(8)])
+        efb = self.signed(regs[0x0D])
+        evol = np.array([self.signed(regs[0x2C]), self.signed(regs[0x3C])])
+        result = np.zeros((n, 2), np.int64)
+        self.echo_pos %= delay
+        done = 0
+        writing = not flg & 0x20
+        # While writing, chunks never exceed the delay so feedback is never
+        # read early; a read-only buffer can be swept in one pass
+        while done < n:
+            if writing:
+                count = min(n - done, delay - self.echo_pos)
+            else:
+                count = n - done
+            frames = (self.echo_pos + np.arange(count)) % delay
+            words = ((esa + frames * 4) & 0xFFFF) >> 1
+            echoed = np.stack((self.aram16[words], self.aram16[words + 1]), axis=1).astype(np.int64)
+            history = np.concatenate((self.fir_history, echoed))
+            fir = np.stack([np.convolve(history[:, c], coef[::-1], 'valid')
+                            for c in range(2)], axis=1) >> 6
+            self.fir_history = history[-7:]
+            result[done:done + count] = (fir * evol) >> 7
+            if writing:
+                feedback = echo_in[done:done + count] + ((fir * efb) >> 7)
+                feedback = np.clip(feedback, -32768, 32767) & ~1
+                self.aram16[words] = feedback[:, 0]
+                self.aram16[words + 1] = feedback[:, 1]
+                self.brr.invalidate((esa + self.echo_pos * 4) & 0xFFFF, count * 4)
+            self.echo_pos = (self.echo_pos + count) % delay
+            done += count
+        return result
+    
+    @staticmethod
+    def signed(value):
+        return value - 256 if value & 0x80 else value
+
+class APU:
+    """Audio Processing Unit - 64KB ARAM and the S-DSP"""
+    SAMPLE_RATE = 32000
+    FRAME_RATE = 60.0988  # NTSC
+    
+    def __init__(self):
+        self.aram = bytearray(64 * 1024)
+        self.dsp = DSP(self.aram)
+        self.sample_debt = 0.0
+        
+    def write_aram(self, addr, value):
+        """Write one ARAM byte, invalidating cached BRR decoded from it"""
+        addr &= 0xFFFF
+        self.aram[addr] = value & 0xFF
+        if (addr >> 8) in self.dsp.brr.pages:
+            self.dsp.brr.invalidate(addr)
+    
+    def load_aram(self, addr, data):
+        """Copy a block into ARAM"""
+        addr &= 0xFFFF
+        data = bytes(data)[:0x10000 - addr]
+        self.aram[addr:addr + len(data)] = data
+        self.dsp.brr.invalidate(addr, max(1, len(data)))
+    
+    def end_frame(self):
+        """Generate the audio for one video frame"""
+        self.sample_debt += self.SAMPLE_RATE / self.FRAME_RATE
+        count = int(self.sample_debt)
+        self.sample_debt -= count
+        return self.dsp.generate(count)
+
+class AudioRingBuffer:
+    """Single-producer/single-consumer stereo sample ring
+    
+    The emulation thread only advances write_pos and the audio callback only
+    advances read_pos, so neither side ever takes a lock.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = np.zeros((capacity, 2), np.int16)
+        self.write_pos = 0
+        self.read_pos = 0
+        self.last = np.zeros(2, np.int16)
+        
+    def fill(self):
+        return self.write_pos - self.read_pos
+    
+    def write(self, samples):
+        """Append samples, dropping whatever does not fit; returns count"""
+        count = min(len(samples), self.capacity - self.fill())
+        start = self.write_pos % self.capacity
+        first = min(count, self.capacity - start)
+        self.data[start:start + first] = samples[:first]
+        self.data[:count - first] = samples[first:count]
+        self.write_pos += count
+        return count
+    
+    def read(self, n):
+        """Take n samples, repeating the last one on underrun"""
+        out = np.empty((n, 2), np.int16)
+        count = min(n, self.fill())
+        start = self.read_pos % self.capacity
+        first = min(count, self.capacity - start)
+        out[:first] = self.data[start:start + first]
+        out[first:count] = self.data[:count - first]
+        if count:
+            self.last = out[count - 1].copy()
+        out[count:] = self.last
+        self.read_pos += count
+        return out
+
+class AudioOutput:
+    """Sound card sink - ring buffer plus dynamic rate control
+    
+    Each frame's samples are resampled by up to MAX_DELTA so the ring stays
+    half full; that absorbs the drift between the frame pacer and the sound
+    card clock without audible pitch change.
+    """
+    MAX_DELTA = 0.005
+    
+    def __init__(self, rate=APU.SAMPLE_RATE, latency=0.064):
+        self.rate = rate
+        self.ring = AudioRingBuffer(int(rate * latency) * 2)
+        self.stream = None
+        
+    def start(self):
+        """Open the output device; returns False when none is available"""
+        try:
+            import sounddevice
+            self.stream = sounddevice.OutputStream(
+                samplerate=self.rate, channels=2, dtype='int16',
+                callback=self.callback)
+            self.stream.start()
+        except Exception:
+            self.stream = None
+        return self.stream is not None
+    
+    def callback(self, outdata, frames, time_info, status):
+        outdata[:] = self.ring.read(frames)
+        
+    def write(self, samples):
+        n = len(samples)
+        if n == 0:
+            return
+        half = self.ring.capacity / 2
+        ratio = 1.0 + self.MAX_DELTA * (half - self.ring.fill()) / half
+        count = max(1, int(round(n * ratio)))
+        if count != n:
+            src = np.arange(n)
+            dst = np.linspace(0, n - 1, count)
+            samples = np.stack([np.interp(dst, src, samples[:, c]) for c in range(2)],
+                               axis=1).astype(np.int16)
+        self.ring.write(samples)
+        
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+class WAVWriter:
+    """Streaming WAV sink - appends each frame's samples to a file"""
+    def __init__(self, path, rate=APU.SAMPLE_RATE):
+        self.wav = wave.open(str(path), 'wb')
+        self.wav.setnchannels(2)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(rate)
+        
+    def write(self, samples):
+        self.wav.writeframesraw(samples.astype('<i2', copy=False).tobytes())
+        
+    def close(self):
+        self.wav.close()
+
+class FrameCapture:
+    """Video capture sink - a writer thread encodes frames off a bounded queue
+    
+    write() only copies the framebuffer. When the queue is full, policy
+    'drop' discards the frame (counted in dropped) and 'block' waits for
+    the writer. Once the writer fails, frames are discarded and close()
+    raises its error. Paths ending in .y4m get one 4:2:0 YUV4MPEG2 stream; any
+    other path is a PNG name pattern, so shot.png becomes shot_000000.png,
+    shot_000001.png, and so on.
+    """
+    WIDTH, HEIGHT = 256, 224
+    
+    def __init__(self, path, policy='drop', depth=8):
+        if policy not in ('drop', 'block'):
+            raise ValueError(f"Unknown capture policy {policy!r}")
+        self.path = str(path)
+        self.policy = policy
+        self.queue = queue.Queue(depth)
+        self.frames = 0
+        self.dropped = 0
+        self.error = None
+        if self.path.lower().endswith('.y4m'):
+            self.file = open(self.path, 'wb')
+            self.file.write(f"YUV4MPEG2 W{self.WIDTH} H{self.HEIGHT} F60099:1000 "
+                            f"Ip A1:1 C420jpeg\n".encode())
+            self.encode = self.write_y4m
+        else:
+            self.file = None
+            self.encode = self.write_png
+        self.thread = threading.Thread(target=self.run, name='FrameCapture', daemon=True)
+        self.thread.start()
+        
+    def write(self, frame_buffer):
+        if self.error is not None:
+            return
+        frame = bytes(frame_buffer)
+        if self.policy == 'block':
+            self.queue.put(frame)
+            return
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+    
+    def run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error is None:
+                try:
+                    self.encode(frame)
+                    self.frames += 1
+                except Exception as e:
+                    self.error = e  # keep draining so write() never stalls
+    
+    def write_y4m(self, frame):
+        rgb = np.frombuffer(frame, np.uint8).reshape(self.HEIGHT, self.WIDTH, 3).astype(np.float32)
+        r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+        # Full-range BT.601, chroma averaged over 2x2 blocks
+        y = 0.299 * r + 0.587 * g + 0.114 * b
+        u = (b - y) * 0.564 + 128
+        v = (r - y) * 0.713 + 128
+        planes = [y] + [c.reshape(self.HEIGHT // 2, 2, self.WIDTH // 2, 2).mean(axis=(1, 3))
+                        for c in (u, v)]
+        self.file.write(b'FRAME\n')
+        for plane in planes:
+            self.file.write(np.clip(plane + 0.5, 0, 255).astype(np.uint8).tobytes())
+    
+    def write_png(self, frame):
+        def chunk(kind, data):
+            return (struct.pack('>I', len(data)) + kind + data
+                    + struct.pack('>I', zlib.crc32(kind + data)))
+        stride = self.WIDTH * 3
+        view = memoryview(frame)
+        rows = b''.join(b'\0' + view[y * stride:(y + 1) * stride]
+                        for y in range(self.HEIGHT))
+        stem, extension = os.path.splitext(self.path)
+        with open(f"{stem}_{self.frames:06d}{extension or '.png'}", 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n')
+            f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', self.WIDTH, self.HEIGHT, 8, 2, 0, 0, 0)))
+            f.write(chunk(b'IDAT', zlib.compress(rows, 6)))
+            f.write(chunk(b'IEND', b''))
+    
+    def close(self):
+        """Finish writing queued frames; returns (frames written, dropped)"""
+        self.queue.put(None)
+        self.thread.join()
+        if self.file is not None:
+            self.file.close()
+        if self.error is not None:
+            raise self.error
+        return self.frames, self.dropped
+
+class Controller:
+    """SNES Controller Input
+    
+    Buttons live in one 16-bit mask ($4218/$4219 bit order). The game sees
+    a copy latched once per frame at VBlank, through the auto-joypad
+    registers ($4218 + 2 * port) and the serial port ($4016 + port).
+    """
+    BUTTONS = {
+        'b': 0x8000, 'y': 0x4000, 'select': 0x2000, 'start': 0x1000,
+        'up': 0x0800, 'down': 0x0400, 'left': 0x0200, 'right': 0x0100,
+        'a': 0x0080, 'x': 0x0040, 'l': 0x0020, 'r': 0x0010
+    }
+    STATE = struct.Struct('<HHB')
+    
+    def __init__(self, port=0):
+        self.port = port
+        self.mask = 0     # live buttons, updated by key events
+        self.latched = 0  # what the game reads this frame
+        self.shift = 0    # $4016 serial shift register
+        self.strobe = 0
+        
+    def press(self, button):
+        self.mask |= self.BUTTONS.get(button, 0)
+            
+    def release(self, button):
+        self.mask &= ~self.BUTTONS.get(button, 0)
+    
+    def state(self):
+        """Buttons as a 16-bit mask"""
+        return self.mask
+    
+    def set_state(self, mask):
+        self.mask = mask & 0xFFFF
+    
+    def latch(self):
+        """Auto-joypad read at the start of VBlank"""
+        self.latched = self.shift = self.mask
+    
+    def read_joypad(self, offset):
+        """$4218-$421F: auto-joypad results for this port"""
+        base = 0x4218 + 2 * self.port
+        if offset == base:
+            return self.latched & 0xFF
+        if offset == base + 1:
+            return self.latched >> 8
+        return 0
+    
+    def read_serial(self, offset):
+        """$4016/$4017: next button bit, B first; 1s once all 16 are shifted out"""
+        if offset != 0x4016 + self.port:
+            return 0
+        if self.strobe:
+            return self.mask >> 15
+        bit = self.shift >> 15
+        self.shift = ((self.shift << 1) | 1) & 0xFFFF
+        return bit
+    
+    def write_strobe(self, offset, value):
+        """$4016 bit 0 reloads the shift register while high"""
+        self.strobe = value & 1
+        if self.strobe:
+            self.shift = self.mask
+    
+    def state_chunks(self):
+        return [self.STATE.pack(self.latched, self.shift, self.strobe)]
+    
+    def load_state(self, view, offset):
+        self.latched, self.shift, self.strobe = self.STATE.unpack_from(view, offset)
+        return offset + self.STATE.size
+
+class Movie:
+    """Controller mask per emulated frame, run-length encoded on disk"""
+    def __init__(self, rom_hash, frames=()):
+        self.rom_hash = rom_hash
+        self.frames = array('H', frames)
+        
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(MOVIE_HEADER.pack(MOVIE_MAGIC, MOVIE_VERSION,
+                                      self.rom_hash, len(self.frames)))
+            runs = []
+            frames = self.frames
+            i = 0
+            while i < len(frames):
+                mask = frames[i]
+                j = i + 1
+                while j < len(frames) and frames[j] == mask and j - i < 0xFFFF:
+                    j += 1
+                runs.append(MOVIE_RUN.pack(j - i, mask))
+                i = j
+            f.write(b''.join(runs))
+    
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, rom_hash, count = MOVIE_HEADER.unpack_from(data)
+        if magic != MOVIE_MAGIC:
+            raise ValueError("Not a movie file")
+        if version != MOVIE_VERSION:
+            raise ValueError(f"Unsupported movie version {version}")
+        movie = cls(rom_hash)
+        for repeat, mask in MOVIE_RUN.iter_unpack(memoryview(data)[MOVIE_HEADER.size:]):
+            movie.frames.extend([mask] * repeat)
+        if len(movie.frames) != count:
+            raise ValueError("Truncated movie file")
+        return movie
+
+class RewindBuffer:
+    """Ring of per-frame savestates stored as XOR deltas against a keyframe
+    
+    Consecutive frames differ in a handful of WRAM/VRAM bytes, so the XOR
+    against the group's keyframe is mostly zeros and compresses to almost
+    nothing. Whole groups are evicted oldest-first to stay within budget.
+    """
+    def __init__(self, budget=64 * 1024 * 1024, keyframe_interval=60):
+        self.budget = budget
+        self.keyframe_interval = keyframe_interval
+        self.groups = deque()  # [keyframe_blob, [delta_blobs]]
+        self.keyframe = None   # uncompressed keyframe of the newest group
+        self.size = 0
+        
+    def __len__(self):
+        return sum(1 + len(deltas) for _, deltas in self.groups)
+    
+    def push(self, state):
+        """Record one uncompressed savestate"""
+        if (not self.groups or len(state) != len(self.keyframe)
+                or len(self.groups[-1][1]) + 1 >= self.keyframe_interval):
+            blob = zlib.compress(state, 1)
+            self.groups.append([blob, []])
+            self.keyframe = state
+        else:
+            delta = np.bitwise_xor(np.frombuffer(state, np.uint8),
+                                   np.frombuffer(self.keyframe, np.uint8))
+            blob = zlib.compress(delta, 1)
+            self.groups[-1][1].append(blob)
+        self.size += len(blob)
+        
+        while self.size > self.budget and len(self.groups) > 1:
+            keyframe, deltas = self.groups.popleft()
+            self.size -= len(keyframe) + sum(len(blob) for blob in deltas)
+    
+    def pop(self):
+        """Remove and return the newest state, or None when empty"""
+        if not self.groups:
+            return None
+        keyframe, deltas = self.groups[-1]
+        if deltas:
+            blob = deltas.pop()
+            self.size -= len(blob)
+            delta = np.frombuffer(zlib.decompress(blob), np.uint8)
+            return np.bitwise_xor(delta, np.frombuffer(self.keyframe, np.uint8)).tobytes()
+        self.groups.pop()
+        self.size -= len(keyframe)
+        state = self.keyframe
+        self.keyframe = zlib.decompress(self.groups[-1][0]) if self.groups else None
+        return state
+    
+    def clear(self):
+        self.groups.clear()
+        self.keyframe = None
+        self.size = 0
+
+SRAM_FLUSH_INTERVAL = 2.0  # seconds between batched .srm writes while running
+ROM_EXTENSIONS = ('.sfc', '.smc', '.fig', '.swc')
+ARCHIVE_EXTENSIONS = ('.zip', '.gz')
+READ_CHUNK = 1 << 20
+
+def map_file(path, access=mmap.ACCESS_READ):
+    """mmap of a whole file, read-only unless access says otherwise"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return bytearray()
+        return mmap.mmap(f.fileno(), 0, access=access)
+
+def open_sram(path, size):
+    """Battery SRAM of size bytes as a shared mmap of the .srm file at path,
+    created or resized (keeping its contents) as needed"""
+    with open(path, 'a+b') as f:
+        if os.fstat(f.fileno()).st_size != size:
+            f.truncate(size)
+        return mmap.mmap(f.fileno(), size)
+
+def sram_file(rom_path):
+    """Path of the .srm battery save kept next to a ROM"""
+    return os.path.splitext(rom_path)[0] + '.srm'
+
+def read_sram(path, size):
+    """Battery SRAM of size bytes as a private copy of the .srm file at path,
+    zero-filled past its end or if there is none"""
+    sram = bytearray(size)
+    try:
+        with open(path, 'rb') as f:
+            f.readinto(sram)
+    except FileNotFoundError:
+        pass
+    return sram
+
+def read_into(stream, view):
+    """Fill view from a stream in chunks; the image is never copied whole"""
+    pos = 0
+    while pos < len(view):
+        count = stream.readinto(view[pos:pos + READ_CHUNK])
+        if not count:
+            break
+        pos += count
+    if pos != len(view):
+        raise ValueError(f"Archive member is {pos} bytes, expected {len(view)}")
+
+def rom_member(path):
+    """Name of the ROM image in a .zip or .gz archive, or None if it holds none
+    
+    A zip's ROM is its largest member with a ROM_EXTENSIONS name; a .gz
+    holds one when the name it was compressed from (path minus .gz) has one.
+    """
+    lower = str(path).lower()
+    if lower.endswith('.gz'):
+        return os.path.basename(path)[:-3] if lower[:-3].endswith(ROM_EXTENSIONS) else None
+    with zipfile.ZipFile(path) as archive:
+        roms = [info for info in archive.infolist()
+                if not info.is_dir() and info.filename.lower().endswith(ROM_EXTENSIONS)]
+    return max(roms, key=lambda info: info.file_size).filename if roms else None
+
+def open_archive(path):
+    """(stream, size) for the ROM inside a .zip or .gz, or None for plain files
+    
+    Raises ValueError for an archive without a ROM image in it.
+    """
+    lower = str(path).lower()
+    if not lower.endswith(ARCHIVE_EXTENSIONS):
+        return None
+    member = rom_member(path)
+    if member is None:
+        raise ValueError(f"No SNES ROM in {os.path.basename(path)}")
+    if lower.endswith('.gz'):
+        with open(path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            size, = struct.unpack('<I', f.read(4))  # ISIZE trailer
+        return gzip.open(path, 'rb'), size
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(member)
+        # The member stream keeps the archive file open after this block
+        return archive.open(info), info.file_size
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ROMCache:
+    """Size-bounded directory of decompressed ROM images keyed by archive SHA-1
+    
+    Images are decompressed straight into an mmap of their cache file, and
+    later launches just mmap that file. The least recently used files are
+    deleted once the directory grows past budget bytes.
+    """
+    def __init__(self, directory=None, budget=256 * 1024 * 1024):
+        self.directory = Path(directory or Path.home() / '.cache' / 'zmz' / 'roms')
+        self.budget = budget
+        
+    def open(self, key, access=mmap.ACCESS_READ):
+        path = self.directory / f"{key}.sfc"
+        if not path.exists():
+            return None
+        os.utime(path)  # mark as recently used
+        return map_file(path, access)
+    
+    def store(self, key, size, stream, access=mmap.ACCESS_READ):
+        """Decompress stream into a new cache file; returns its mmap"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{key}.sfc"
+        temp = path.with_suffix('.tmp')
+        with open(temp, 'w+b') as f:
+            f.truncate(size)
+            if size:
+                with mmap.mmap(f.fileno(), size) as image:
+                    read_into(stream, memoryview(image))
+        os.replace(temp, path)
+        self.trim(keep=path)
+        return self.open(key, access)
+    
+    def trim(self, keep=None):
+        files = sorted(self.directory.glob('*.sfc'), key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in files)
+        for path in files:
+            if total <= self.budget:
+                break
+            if path != keep:
+                total -= path.stat().st_size
+                path.unlink()
+
+def open_rom_image(path, cache=None, access=mmap.ACCESS_READ):
+    """ROM image for path: an mmap for plain files and cached archives,
+    otherwise the archive decompressed in chunks into a single buffer.
+    Pass access=mmap.ACCESS_COPY for an image that can be patched."""
+    archive = open_archive(path)
+    if archive is None:
+        return map_file(path, access)
+    stream, size = archive
+    with stream:
+        if cache is None:
+            image = bytearray(size)
+            read_into(stream, memoryview(image))
+            return image
+        key = hash_file(path)
+        image = cache.open(key, access)
+        if image is None:
+            image = cache.store(key, size, stream, access)
+        return image
+
+PATCH_EXTENSIONS = ('.bps', '.ips')
+
+def find_patch(path):
+    """A .bps or .ips soft patch sitting next to the ROM at path, if any"""
+    stem = os.path.splitext(path)[0]
+    for extension in PATCH_EXTENSIONS:
+        if os.path.exists(stem + extension):
+            return stem + extension
+    return None
+
+def apply_patch(rom, path):
+    """Apply an IPS or BPS patch file to a ROM image; returns the result
+    
+    IPS records are written into rom itself when it is writable (such as a
+    copy-on-write mmap) and large enough, so only the touched pages are
+    copied. BPS builds a new image, reading the patch in chunks.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(5)
+        if magic == b'PATCH':
+            return apply_ips(rom, f)
+        if magic[:4] == b'BPS1':
+            f.seek(4)
+            return apply_bps(rom, f, os.fstat(f.fileno()).st_size)
+    raise ValueError(f"{path} is not an IPS or BPS patch")
+
+def apply_ips(rom, f):
+    records = []
+    end = len(rom)
+    while True:
+        head = f.read(3)
+        if len(head) < 3:
+            raise ValueError("Truncated IPS patch")
+        if head == b'EOF':
+            break
+        offset = int.from_bytes(head, 'big')
+        size, = struct.unpack('>H', f.read(2))
+        if size:
+            data = f.read(size)
+        else:
+            count, value = struct.unpack('>HB', f.read(3))
+            data = bytes([value]) * count
+        records.append((offset, data))
+        end = max(end, offset + len(data))
+    truncate = f.read(3)
+    if len(truncate) == 3:
+        end = int.from_bytes(truncate, 'big')
+    if memoryview(rom).readonly or end != len(rom):
+        image = bytearray(end)
+        count = min(end, len(rom))
+        image[:count] = memoryview(rom)[:count]
+        rom = image
+    for offset, data in records:
+        rom[offset:offset + len(data)] = data[:max(0, end - offset)]
+    return rom
+
+def read_bps_number(f):
+    data, shift = 0, 1
+    while True:
+        byte = f.read(1)[0]
+        data += (byte & 0x7F) * shift
+        if byte & 0x80:
+            return data
+        shift <<= 7
+        data += shift
+
+def apply_bps(rom, f, patch_size):
+    source = memoryview(rom)
+    source_size = read_bps_number(f)
+    target_size = read_bps_number(f)
+    f.seek(read_bps_number(f), os.SEEK_CUR)  # metadata
+    if source_size != len(source):
+        raise ValueError(f"BPS patch expects a {source_size} byte ROM, got {len(source)}")
+    target = bytearray(target_size)
+    view = memoryview(target)
+    out = source_offset = target_offset = 0
+    body_end = patch_size - 12
+    while f.tell() < body_end:
+        data = read_bps_number(f)
+        command, length = data & 3, (data >> 2) + 1
+        if command == 0:    # SourceRead
+            view[out:out + length] = source[out:out + length]
+        elif command == 1:  # TargetRead
+            read_into(f, view[out:out + length])
+        elif command == 2:  # SourceCopy
+            data = read_bps_number(f)
+            source_offset += -(data >> 1) if data & 1 else data >> 1
+            view[out:out + length] = source[source_offset:source_offset + length]
+            source_offset += length
+        else:               # TargetCopy, which may overlap its own output
+            data = read_bps_number(f)
+            target_offset += -(data >> 1) if data & 1 else data >> 1
+            if target_offset >= out:
+                raise ValueError("BPS TargetCopy reads ahead of its output")
+            start, end = out, out + length
+            while start < end:
+                chunk = min(end - start, start - target_offset)
+                view[start:start + chunk] = view[target_offset:target_offset + chunk]
+                start += chunk
+                target_offset += chunk
+        out += length
+    source_crc, target_crc = struct.unpack('<II', f.read(8))
+    if zlib.crc32(source) != source_crc:
+        raise ValueError("BPS patch is for a different ROM")
+    if zlib.crc32(target) != target_crc:
+        raise ValueError("BPS patch produced a corrupt ROM")
+    return target
+
+GAME_GENIE_DIGITS = 'DF4709156BC8A23E'
+# Game Genie address bits, in code order, as positions in the real address
+GAME_GENIE_BITS = [23 - 'abcdefghijklmnopqrstuvwx'.index(bit)
+                   for bit in 'ijklqrstopabcduvwxefghmn']
+
+def decode_cheat(code):
+    """(bus address, value) for a Game Genie (DDDD-DDDD) or Pro Action
+    Replay (AAAAAAVV or AAAAAA:VV) code"""
+    text = code.strip().upper()
+    if len(text) == 9 and text[4] == '-':
+        digits = text.replace('-', '')
+        if any(digit not in GAME_GENIE_DIGITS for digit in digits):
+            raise ValueError(f"Bad Game Genie code {code!r}")
+        raw = int(''.join('%X' % GAME_GENIE_DIGITS.index(d) for d in digits), 16)
+        value, scrambled = raw >> 24, raw & 0xFFFFFF
+        addr = 0
+        for position, bit in enumerate(GAME_GENIE_BITS):
+            if scrambled >> (23 - position) & 1:
+                addr |= 1 << bit
+        return addr, value
+    digits = text.replace(':', '')
+    if len(digits) == 8:
+        try:
+            raw = int(digits, 16)
+        except ValueError:
+            pass
+        else:
+            return raw >> 8, raw & 0xFF
+    raise ValueError(f"Unrecognised cheat code {code!r}")
+
+def scan_rom_file(path):
+    """Hash and parse one ROM file; runs in library scanner worker processes
+    
+    Returns None for an archive with no ROM image in it.
+    """
+    if path.lower().endswith(ARCHIVE_EXTENSIONS) and rom_member(path) is None:
+        return None
+    data = open_rom_image(path)
+    if len(data) % 1024 == 512:
+        data = memoryview(data)[512:]
+    header = detect_header(data)
+    return (path, zlib.crc32(data), hashlib.sha1(data).hexdigest(),
+            header.title if header else '', header.mapping if header else '',
+            header.region if header else 0, len(data))
+
+class ROMLibrary:
+    """Persistent SQLite index of ROM files
+    
+    Rows are keyed by path and carry the file's mtime and size, so a rescan
+    only re-hashes files that changed. Hashing and header parsing run in a
+    process pool. Each call opens its own connection, so the index can be
+    scanned from a worker thread while the UI searches it.
+    
+    Titles and paths are also indexed in an FTS5 trigram table, kept in
+    step by triggers, so substring searches of three or more characters
+    use the index instead of scanning every row. SQLite builds without
+    FTS5 fall back to scanning.
+    """
+    COLUMNS = ('path', 'mtime', 'size', 'crc32', 'sha1', 'title', 'mapping', 'region', 'rom_size')
+    
+    def __init__(self, path=None):
+        self.path = str(path or Path.home() / '.zmz_library.db')
+        with self.connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS roms (
+                path TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+                crc32 INTEGER, sha1 TEXT, title TEXT, mapping TEXT,
+                region INTEGER, rom_size INTEGER)""")
+            db.execute("CREATE INDEX IF NOT EXISTS roms_title ON roms (title)")
+            self.fts = self.create_search_index(db)
+    
+    @staticmethod
+    def create_search_index(db):
+        """Create the trigram index over roms and its sync triggers if they
+        are missing; returns False when SQLite has no FTS5"""
+        exists = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'roms_search'").fetchone()
+        if exists:
+            return True
+        try:
+            db.execute("""CREATE VIRTUAL TABLE roms_search USING fts5(
+                title, path, content='roms', tokenize='trigram')""")
+        except sqlite3.OperationalError:
+            return False
+        db.executescript("""
+            CREATE TRIGGER roms_search_insert AFTER INSERT ON roms BEGIN
+                INSERT INTO roms_search (rowid, title, path)
+                VALUES (new.rowid, new.title, new.path);
+            END;
+            CREATE TRIGGER roms_search_delete AFTER DELETE ON roms BEGIN
+                INSERT INTO roms_search (roms_search, rowid, title, path)
+                VALUES ('delete', old.rowid, old.title, old.path);
+            END;
+            CREATE TRIGGER roms_search_update AFTER UPDATE ON roms BEGIN
+                INSERT INTO roms_search (roms_search, rowid, title, path)
+                VALUES ('delete', old.rowid, old.title, old.path);
+                INSERT INTO roms_search (rowid, title, path)
+                VALUES (new.rowid, new.title, new.path);
+            END;
+            INSERT INTO roms_search (roms_search) VALUES ('rebuild');
+        """)
+        return True
+            
+    def connect(self):
+        return sqlite3.connect(self.path)
+    
+    def scan(self, directories, workers=None):
+        """Index ROMs under directories; returns (files, updated, removed,
+        failed), failed being (path, error) for files that could not be read
+        
+        A file that fails is skipped; the rest of the scan is still committed.
+        """
+        found = {}
+        for directory in directories:
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    if name.lower().endswith(ROM_EXTENSIONS + ARCHIVE_EXTENSIONS):
+                        path = os.path.abspath(os.path.join(root, name))
+                        try:
+                            st = os.stat(path)
+                        except OSError:
+                            continue
+                        found[path] = (st.st_mtime, st.st_size)
+        
+        with self.connect() as db:
+            known = {}
+            for directory in directories:
+                prefix = os.path.join(os.path.abspath(directory), '')
+                for path, mtime, size in db.execute(
+                        "SELECT path, mtime, size FROM roms WHERE substr(path, 1, ?) = ?",
+                        (len(prefix), prefix)):
+                    known[path] = (mtime, size)
+        changed = [path for path, stamp in found.items() if known.get(path) != stamp]
+        removed = [path for path in known if path not in found]
+        
+        rows = []
+        failed = []
+        if changed:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [(path, pool.submit(scan_rom_file, path)) for path in changed]
+                for path, future in futures:
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        failed.append((path, f"{type(e).__name__}: {e}"))
+                        continue
+                    if result is None:
+                        # An archive of something else: not a ROM, nor an error
+                        del found[path]
+                        if path in known:
+                            removed.append(path)
+                        continue
+                    rows.append((path,) + found[path] + result[1:])
+        
+        # An upsert rather than INSERT OR REPLACE, whose implicit delete
+        # would not fire the search index trigger
+        updates = ', '.join(f"{column} = excluded.{column}" for column in self.COLUMNS[1:])
+        with self.connect() as db:
+            db.executemany(f"INSERT INTO roms VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                           f"ON CONFLICT (path) DO UPDATE SET {updates}", rows)
+            db.executemany("DELETE FROM roms WHERE path = ?", [(path,) for path in removed])
+        return len(found), len(rows), len(removed), failed
+    
+    def search(self, text='', limit=500):
+        """(path, title, mapping, crc32) rows whose title or path contains text
+        
+        Matching ignores ASCII case. Text of three or more characters is
+        looked up in the trigram index; anything shorter has to scan.
+        """
+        with self.connect() as db:
+            if self.fts and len(text) >= 3:
+                query = '"' + text.replace('"', '""') + '"'
+                return db.execute(
+                    "SELECT roms.path, roms.title, roms.mapping, roms.crc32 "
+                    "FROM roms_search JOIN roms ON roms.rowid = roms_search.rowid "
+                    "WHERE roms_search MATCH ? ORDER BY roms.title, roms.path LIMIT ?",
+                    (query, limit)).fetchall()
+            pattern = f"%{text}%"
+            return db.execute(
+                "SELECT path, title, mapping, crc32 FROM roms "
+                "WHERE title LIKE ? OR path LIKE ? ORDER BY title, path LIMIT ?",
+                (pattern, pattern, limit)).fetchall()
+
+SCANLINES_PER_FRAME = 262
+VBLANK_SCANLINE = 225
+CPU_STEPS_PER_SCANLINE = 100  # ~1364 master clocks at 2-3 cycle opcodes
+
+class SNESCore:
+    """Headless SNES - steps all components one video frame at a time"""
+    STATE = struct.Struct('<QBh')
+    
+    def __init__(self, timing='fast'):
+        self.memory = Memory()
+        self.cpu = CPU65C816(self.memory, timing)
+        self.debugger = Debugger(self.cpu)
+        self.ppu = PPU(self.memory)
+        self.apu = APU()
+        self.controller = Controller()
+        self.controller2 = Controller(port=1)
+        self.frame_count = 0
+        self.audio = None  # samples produced by the last frame
+        self.audio_sinks = []  # objects with write(samples)
+        self.rom_hash = bytes(20)
+        self.movie = None
+        self.movie_playing = False
+        self.nmitimen = 0  # $4200, bit 0 enables auto-joypad read
+        self.cheats = {}  # code -> (addr, value)
+        self.freezes = []  # (addr, value) written every VBlank
+        # Instructions left on scanline ppu.scanline when a breakpoint
+        # stopped the frame there; None between scanlines
+        self.line_steps = None
+        
+        io_read = self.memory.io_read
+        io_write = self.memory.io_write
+        io_read[0x4016] = self.controller.read_serial
+        io_read[0x4017] = self.controller2.read_serial
+        io_write[0x4016] = self.write_strobe
+        for offset in range(0x4218, 0x4220):
+            io_read[offset] = self.controller.read_joypad
+        io_read[0x421A] = io_read[0x421B] = self.controller2.read_joypad
+        io_write[0x4200] = self.write_nmitimen
+        io_write[0x420D] = self.write_memsel
+        
+    def load_rom(self, data, sram_path=None, patch_path=None, battery=True):
+        """Load ROM data, skipping a copier header, and reset the CPU
+        
+        A patch_path IPS/BPS file is applied before the ROM is mapped;
+        give it a copy-on-write image (see open_rom_image) to patch in place.
+        Without battery, SRAM is a private copy of sram_path (see Memory.load_rom).
+        """
+        if len(data) % 1024 == 512:
+            data = memoryview(data)[512:]
+        if patch_path is not None:
+            data = apply_patch(data, patch_path)
+        self.cheats = {}
+        self.freezes = []
+        self.memory.rom_cheats = {}
+        self.memory.load_rom(data, sram_path, battery)
+        self.rom_hash = hashlib.sha1(self.memory.rom).digest()
+        self.reset()
+        
+    def load_rom_file(self, filename, cache=None, battery=True):
+        """Load a ROM or archive with its .srm battery save and any soft
+        patch next to it; returns the patch path or None
+        
+        Without battery the save is copied in but never written back, for
+        headless and batch runs that must leave it alone.
+        """
+        patch = find_patch(filename)
+        access = mmap.ACCESS_COPY if patch else mmap.ACCESS_READ
+        self.load_rom(open_rom_image(filename, cache, access),
+                      sram_file(filename), patch, battery)
+        return patch
+    
+    def reset(self):
+        self.cpu.reset()
+        self.ppu.scanline = 0
+        self.line_steps = None
+        self.memory.generation += 1
+    
+    def add_cheat(self, code):
+        """Enable a Game Genie or Pro Action Replay code
+        
+        Codes for ROM addresses are compiled into the bus page table; the
+        rest freeze their address, rewritten once per frame at VBlank.
+        """
+        addr, value = decode_cheat(code)
+        self.cheats[code] = (addr, value)
+        self.compile_cheats()
+        return addr, value
+    
+    def remove_cheat(self, code):
+        del self.cheats[code]
+        self.compile_cheats()
+    
+    def compile_cheats(self):
+        memory = self.memory
+        rom_cheats = {}
+        self.freezes = []
+        for addr, value in self.cheats.values():
+            index = addr >> 12
+            if memory.read_backing[index] is not None and memory.write_backing[index] is None:
+                rom_cheats[addr] = value
+            else:
+                self.freezes.append((addr, value))
+        memory.rom_cheats = rom_cheats
+        memory.build_page_table()
+    
+    def write_nmitimen(self, offset, value):
+        self.nmitimen = value
+    
+    def write_memsel(self, offset, value):
+        self.memory.memsel = value & 1
+    
+    def write_strobe(self, offset, value):
+        """$4016 strobes both controller ports"""
+        self.controller.write_strobe(offset, value)
+        self.controller2.write_strobe(offset, value)
+    
+    def power_on(self):
+        """Cold boot with the current ROM: cleared RAM and registers
+        
+        SRAM is cleared too, for movies and link play to start identically,
+        so it is first detached from its .srm file: the battery save is left
+        alone until stop_movie or the next ROM load reattaches it.
+        """
+        self.memory.detach_battery()
+        self.memory.clear()
+        cpu = self.cpu
+        cpu.a = cpu.x = cpu.y = cpu.db = cpu.d = cpu.cycles = cpu.wait_clocks = 0
+        self.memory.memsel = 0
+        cpu.reset()
+        self.ppu.scanline = 0
+        self.line_steps = None
+        self.frame_count = 0
+        self.nmitimen = 0
+        for controller in (self.controller, self.controller2):
+            controller.latched = controller.shift = controller.strobe = 0
+    
+    def start_recording(self):
+        """Power on and record input from frame 0"""
+        self.power_on()
+        self.movie = Movie(self.rom_hash)
+        self.movie_playing = False
+        
+    def start_playback(self, movie):
+        """Power on and replay a movie recorded against this ROM"""
+        if movie.rom_hash != self.rom_hash:
+            raise ValueError("Movie was recorded with a different ROM")
+        self.power_on()
+        self.movie = movie
+        self.movie_playing = True
+        
+    def stop_movie(self):
+        """End recording or playback; SRAM goes back to the battery save"""
+        movie = self.movie
+        self.movie = None
+        self.movie_playing = False
+        self.memory.attach_battery()
+        return movie
+    
+    def save_state(self, compression=None):
+        """Serialize CPU, PPU and memory; compression is None, 'zlib' or 'lzma'"""
+        line_steps = -1 if self.line_steps is None else self.line_steps
+        chunks = [self.STATE.pack(self.frame_count, self.nmitimen, line_steps)]
+        chunks += self.controller.state_chunks()
+        chunks += self.controller2.state_chunks()
+        chunks += self.cpu.state_chunks()
+        chunks += self.ppu.state_chunks()
+        chunks += self.memory.state_chunks()
+        payload = b''.join(chunks)
+        size = len(payload)
+        if compression == 'zlib':
+            payload = zlib.compress(payload, 1)
+        elif compression == 'lzma':
+            payload = lzma.compress(payload, preset=0)
+        header = STATE_HEADER.pack(STATE_MAGIC, STATE_VERSION,
+                                   STATE_CODECS[compression], size)
+        return header + payload
+    
+    def load_state(self, data):
+        """Restore a state produced by save_state"""
+        magic, version, codec, size = STATE_HEADER.unpack_from(data)
+        if magic != STATE_MAGIC:
+            raise ValueError("Not a savestate")
+        if version != STATE_VERSION:
+            raise ValueError(f"Unsupported savestate version {version}")
+        view = memoryview(data)[STATE_HEADER.size:]
+        if codec == 1:
+            view = memoryview(zlib.decompress(view))
+        elif codec == 2:
+            view = memoryview(lzma.decompress(view))
+        if len(view) != size:
+            raise ValueError("Truncated savestate")
+        self.frame_count, self.nmitimen, line_steps = self.STATE.unpack_from(view)
+        self.line_steps = None if line_steps < 0 else line_steps
+        offset = self.controller.load_state(view, self.STATE.size)
+        offset = self.controller2.load_state(view, offset)
+        offset = self.cpu.load_state(view, offset)
+        offset = self.ppu.load_state(view, offset)
+        self.memory.load_state(view, offset)
+        
+    def run_frame(self, render=True, audio=True):
+        """Emulate one frame of CPU, PPU and audio
+        
+        render=False skips drawing scanlines; audio=False leaves the APU
+        and any movie untouched, for speculative frames that will be rolled
+        back. A BreakpointHit leaves the frame part-way through; the next
+        call carries on from the same scanline and instruction.
+        """
+        first = self.ppu.scanline
+        # Movies are indexed by frame_count, so rewinding while recording
+        # simply truncates the recording
+        movie = self.movie
+        if movie is not None and audio and first == 0 and self.line_steps is None:
+            if not self.movie_playing:
+                del movie.frames[self.frame_count:]
+                movie.frames.append(self.controller.state())
+            elif self.frame_count < len(movie.frames):
+                self.controller.set_state(movie.frames[self.frame_count])
+        
+        cpu = self.cpu
+        cpu_run = cpu.run
+        ppu_step = self.ppu.step
+        write = self.memory.write
+        for line in range(first, SCANLINES_PER_FRAME):
+            steps = self.line_steps
+            if steps is None:
+                steps = CPU_STEPS_PER_SCANLINE
+                if line == VBLANK_SCANLINE:
+                    for addr, value in self.freezes:
+                        write(addr, value)
+                    if self.nmitimen & 1:
+                        self.controller.latch()
+                        self.controller2.latch()
+            try:
+                cpu_run(steps)
+            except BreakpointHit:
+                self.line_steps = cpu.steps_left
+                raise
+            self.line_steps = None
+            ppu_step(render)
+        if audio:
+            self.audio = self.apu.end_frame()
+            for sink in self.audio_sinks:
+                sink.write(self.audio)
+        self.frame_count += 1
+        if self.movie_playing and audio and self.frame_count >= len(movie.frames):
+            self.stop_movie()
+    
+    def run_ahead(self, frames):
+        """Run one real frame, then show the frame `frames` ahead of it
+        
+        The real frame is emulated without drawing and the speculative ones
+        with the current input, no audio and no breakpoints; the state is
+        then restored, so input shows up on screen `frames` frames earlier.
+        """
+        self.run_frame(render=False)
+        state = self.save_state()
+        self.debugger.enabled = False
+        try:
+            for i in range(frames):
+                self.run_frame(render=i == frames - 1, audio=False)
+        finally:
+            self.debugger.enabled = True
+            self.load_state(state)
+
+# Link play: hello (magic, version, ROM SHA-1), then (frame, mask) inputs
+LINK_MAGIC = b'ZMZL'
+LINK_VERSION = 1
+LINK_HELLO = struct.Struct('<4sH20s')
+LINK_INPUT = struct.Struct('<IH')
+
+def link_address(text):
+    """(family, address) for 'host:port' (TCP) or a filesystem path (Unix)"""
+    host, sep, port = text.rpartition(':')
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, text
+
+class LinkSession:
+    """Two-player lockstep link over a stream socket, with rollback
+    
+    Each side sends its pad mask for frame f + delay while emulating frame
+    f, so with enough delay the remote input is already there. When it is
+    not, the remote pad is predicted to hold its last known mask. If the
+    real input later turns out different, the core is restored to the
+    savestate taken before that frame and the frames since are re-run
+    without drawing or audio. Emulation stalls rather than running more
+    than max_rollback frames past the last confirmed remote input.
+    """
+    def __init__(self, sock, port, delay=2, max_rollback=8):
+        self.sock = sock
+        self.port = port  # 0: we are player 1
+        self.delay = delay
+        self.max_rollback = max_rollback
+        sock.setblocking(False)
+        if sock.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+        self.rom_hash = None
+        self.peer_ready = False
+        self.reset()
+        
+    def reset(self):
+        self.frame = 0       # next frame to emulate
+        self.confirmed = -1  # newest frame with the remote input known
+        self.last_remote = 0
+        self.local = {}      # frame -> our mask
+        self.remote = {}     # frame -> their mask
+        self.predicted = {}  # frame -> remote mask the frame was run with
+        self.states = {}     # frame -> savestate from just before it
+        self.rollbacks = 0
+        self.rollback_frames = 0
+    
+    @classmethod
+    def host(cls, address, **options):
+        """Wait for the other player to connect; we are player 1"""
+        family, target = link_address(address)
+        with socket.socket(family, socket.SOCK_STREAM) as server:
+            if family == socket.AF_INET:
+                server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            elif os.path.exists(target):
+                os.unlink(target)
+            server.bind(target)
+            server.listen(1)
+            conn, _ = server.accept()
+        return cls(conn, 0, **options)
+    
+    @classmethod
+    def connect(cls, address, **options):
+        """Join a hosted session; we are player 2"""
+        family, target = link_address(address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.connect(target)
+        return cls(sock, 1, **options)
+    
+    def start(self, core):
+        """Cold boot the loaded ROM and announce it to the peer"""
+        self.reset()
+        core.power_on()
+        self.rom_hash = core.rom_hash
+        self.outbox += LINK_HELLO.pack(LINK_MAGIC, LINK_VERSION, core.rom_hash)
+        # Frames before the delay run with no input on either side
+        for frame in range(self.delay):
+            self.send_input(frame, 0)
+    
+    def send_input(self, frame, mask):
+        self.local[frame] = mask
+        self.outbox += LINK_INPUT.pack(frame, mask)
+    
+    def poll(self, core):
+        """Exchange pending bytes; rolls back if a prediction was wrong"""
+        try:
+            if self.outbox:
+                del self.outbox[:self.sock.send(self.outbox)]
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    raise ConnectionError("Link peer disconnected")
+                self.inbox += data
+        except (BlockingIOError, InterruptedError):
+            pass
+        
+        offset = 0
+        if not self.peer_ready:
+            if len(self.inbox) < LINK_HELLO.size:
+                return
+            magic, version, rom_hash = LINK_HELLO.unpack_from(self.inbox)
+            if magic != LINK_MAGIC or version != LINK_VERSION:
+                raise ConnectionError("Link peer speaks a different protocol")
+            if rom_hash != self.rom_hash:
+                raise ConnectionError("Link peer is running a different ROM")
+            self.peer_ready = True
+            offset = LINK_HELLO.size
+        
+        mispredicted = None
+        end = offset + (len(self.inbox) - offset) // LINK_INPUT.size * LINK_INPUT.size
+        for frame, mask in LINK_INPUT.iter_unpack(memoryview(self.inbox)[offset:end]):
+            self.remote[frame] = mask
+            self.confirmed = frame
+            self.last_remote = mask
+            if (mispredicted is None and frame < self.frame
+                    and self.predicted.get(frame) != mask):
+                mispredicted = frame
+        del self.inbox[:end]
+        if mispredicted is not None:
+            self.rollback(core, mispredicted)
+    
+    def rollback(self, core, frame):
+        core.load_state(self.states[frame])
+        self.rollbacks += 1
+        self.rollback_frames += self.frame - frame
+        # Breakpoints already fired when these frames first ran
+        enabled, core.debugger.enabled = core.debugger.enabled, False
+        try:
+            for f in range(frame, self.frame):
+                self.run_frame(core, f, render=False, audio=False)
+        finally:
+            core.debugger.enabled = enabled
+    
+    def run_frame(self, core, frame, render=True, audio=True):
+        self.states[frame] = core.save_state()
+        remote = self.remote.get(frame, self.last_remote)
+        self.predicted[frame] = remote
+        pads = (core.controller, core.controller2)
+        pads[self.port].set_state(self.local[frame])
+        pads[1 - self.port].set_state(remote)
+        core.run_frame(render, audio)
+    
+    def advance(self, core, mask):
+        """Emulate the next frame with our pad held at mask; returns False
+        while waiting for the peer"""
+        self.poll(core)
+        if not self.peer_ready or self.frame - self.confirmed > self.max_rollback:
+            return False
+        frame = self.frame
+        self.send_input(frame + self.delay, mask)
+        self.run_frame(core, frame)
+        self.frame += 1
+        # Frames up to the confirmed one can never be rolled back to
+        for old in [f for f in self.states if f <= self.confirmed]:
+            del self.states[old]
+            del self.predicted[old]
+            self.local.pop(old, None)
+            self.remote.pop(old, None)
+        return True
+    
+    def close(self):
+        self.sock.close()
+
+# Synthetic benchmark programs; each loops forever back to $8000. They use
+# only opcodes the CPU core implements, so every instruction timed is one
+# the core really executes.
+BENCHMARK_MIXES = {
+    'load': bytes([
+        0x18,              # CLC
+        0xA9, 0x12,        # LDA #$12
+        0xA2, 0x34,        # LDX #$34
+        0xA0, 0x00,        # LDY #$00
+        0x38,              # SEC
+        0xA9, 0x80,        # LDA #$80
+        0xA2, 0xFF,        # LDX #$FF
+        0xA0, 0x56,        # LDY #$56
+    ]),
+    'nop': bytes([0xEA] * 16),  # NOP: bare fetch and dispatch
+    'jump': (bytes([0x4C, 0x10, 0x80]).ljust(0x10, b'\xEA')     # JMP $8010
+             + bytes([0x4C, 0x00, 0x81]).ljust(0xF0, b'\xEA')   # JMP $8100
+             + bytes([0x4C, 0x00, 0x90]).ljust(0xF00, b'\xEA')  # JMP $9000, the next 4KB page
+             + bytes([0x18])),                                  # CLC
+}
+
+def build_benchmark_rom(name, code):
+    """Wrap a loop body in a 32KB LoROM image with a valid internal header"""
+    rom = bytearray(0x8000)
+    program = code + bytes([0x4C, 0x00, 0x80])  # JMP $8000
+    rom[:len(program)] = program
+    title = f"ZMZ BENCH {name.upper()}".encode('ascii')[:21].ljust(21)
+    rom[0x7FC0:0x7FD5] = title
+    rom[0x7FD5] = 0x20  # LoROM, SlowROM
+    rom[0x7FD6] = 0x00  # ROM only
+    rom[0x7FD7] = 0x05  # 32KB
+    rom[0x7FD9] = 0x01  # North America
+    for vector in range(0x7FE4, 0x8000, 2):
+        rom[vector:vector + 2] = b'\x00\x80'
+    rom[0x7FDC:0x7FE0] = b'\xFF\xFF\x00\x00'
+    checksum = sum(rom) & 0xFFFF
+    struct.pack_into('<HH', rom, 0x7FDC, checksum ^ 0xFFFF, checksum)
+    return bytes(rom)
+
+def run_benchmark(mixes=None, frames=60, timing='fast'):
+    """Run each synthetic ROM headlessly; returns a JSON-ready dict
+    
+    Whole frames go through SNESCore.run_frame for throughput; each
+    component is then timed on its own for the same amount of work.
+    """
+    timer = time.perf_counter
+    results = []
+    for name in mixes or BENCHMARK_MIXES:
+        core = SNESCore(timing)
+        core.load_rom(build_benchmark_rom(name, BENCHMARK_MIXES[name]))
+        core.memory.write(0x4200, 0x01)
         
-    def load_rom(self, data):
-        """Load ROM data into memory"""
-        self.rom = bytearray(data)
-        # Split into 32KB banks
-        bank_size = 0x8000
-        self.rom_banks = [self.rom[i:i+bank_size] for i in range(0, len(self.rom), bank_size)]
+        start = timer()
+        for _ in range(frames):
+            core.run_frame()
+        elapsed = timer() - start
+        instructions = frames * SCANLINES_PER_FRAME * CPU_STEPS_PER_SCANLINE
+        cycles = core.cpu.cycles
         
-    def read(self, addr):
-        """Read byte from memory address"""
-        bank = (addr >> 16) & 0xFF
-        offset = addr & 0xFFFF
+        start = timer()
+        core.cpu.run_steps(instructions)
+        cpu_time = timer() - start
         
-        # WRAM: $7E0000-$7FFFFF
-        if bank == 0x7E or bank == 0x7F:
-            return self.wram[((bank - 0x7E) << 16) | offset]
+        ppu_step = core.ppu.step
+        start = timer()
+        for _ in range(frames * SCANLINES_PER_FRAME):
+            ppu_step()
+        ppu_time = timer() - start
         
-        # Low RAM mirror: $xx0000-$xx1FFF
-        if offset < 0x2000:
-            return self.wram[offset]
+        start = timer()
+        for _ in range(frames):
+            core.apu.end_frame()
+        apu_time = timer() - start
         
-        # ROM: $80-$FF
-        if bank >= 0x80:
-            rom_bank = bank - 0x80
-            if rom_bank < len(self.rom_banks) and offset >= 0x8000:
-                return self.rom_banks[rom_bank][offset - 0x8000]
+        results.append({
+            'mix': name,
+            'frames': frames,
+            'instructions': instructions,
+            'cycles': cycles,
+            'seconds': elapsed,
+            'instructions_per_sec': instructions / elapsed,
+            'frames_per_sec': frames / elapsed,
+            'component_seconds': {'cpu': cpu_time, 'ppu': ppu_time, 'apu': apu_time},
+        })
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timing': timing,
+        'results': results,
+    }
+
+def run_batch_job(job):
+    """Run one headless instance; runs in batch runner worker processes
+    
+    The ROM is mapped from disk (or the decompressed ROM cache) rather than
+    sent through the pool, so every worker shares the same page cache.
+    """
+    rom_path, movie_path, frames, cache_dir = job
+    result = {'rom': rom_path, 'movie': movie_path}
+    start = time.perf_counter()
+    try:
+        core = SNESCore()
+        # No .srm: jobs start from power-on with zeroed SRAM, so their
+        # digests don't change whenever someone plays the game
+        core.load_rom(open_rom_image(rom_path, ROMCache(cache_dir)))
+        if movie_path is not None:
+            movie = Movie.load(movie_path)
+            core.start_playback(movie)
+            frames = len(movie.frames)
+        frame_buffer = core.ppu.frame_buffer
+        frame_hashes = []
+        for _ in range(frames):
+            core.run_frame()
+            frame_hashes.append(hashlib.blake2b(frame_buffer, digest_size=8).hexdigest())
+        result.update(frames=frames, frame_hashes=frame_hashes,
+                      state_digest=hashlib.sha1(core.save_state()).hexdigest())
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def run_batch(paths, frames=60, workers=None, cache=None):
+    """Run ROMs and .zmv movies in a process pool; returns a JSON-ready dict
+    
+    Every ROM runs for `frames` frames from power-on. Every movie plays to
+    its end on whichever of the given ROMs it was recorded against. The
+    report's digest covers every job's frame hashes and final state, so two
+    runs can be compared at a glance.
+    """
+    cache = cache or ROMCache()
+    roms = {}  # ROM hash -> path
+    movies = []
+    jobs = []
+    for path in paths:
+        if path.lower().endswith('.zmv'):
+            movies.append(path)
+            continue
+        # Also decompresses archives into the cache the workers map from
+        image = open_rom_image(path, cache)
+        if len(image) % 1024 == 512:
+            image = memoryview(image)[512:]
+        roms[hashlib.sha1(image).digest()] = path
+        jobs.append((path, None, frames, str(cache.directory)))
+    for path in movies:
+        rom_path = roms.get(Movie.load(path).rom_hash)
+        if rom_path is None:
+            raise ValueError(f"None of the given ROMs matches movie {path}")
+        jobs.append((rom_path, path, frames, str(cache.directory)))
+    
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run_batch_job, jobs))
+    elapsed = time.perf_counter() - start
+    digest = hashlib.sha1()
+    for result in results:
+        digest.update(json.dumps([result.get('frame_hashes'), result.get('state_digest'),
+                                  result.get('error')]).encode())
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seconds': elapsed,
+        'frames': sum(result.get('frames', 0) for result in results),
+        'failed': sum('error' in result for result in results),
+        'digest': digest.hexdigest(),
+        'results': results,
+    }
+
+class DebuggerWindow:
+    """Disassembly view with register display and single-stepping
+    
+    Rows stay anchored until the PC leaves the visible range, and a row's
+    label is only reconfigured when its text actually changes, so a step
+    usually touches two rows.
+    """
+    ROWS = 24
+    
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.cpu = emulator.cpu
+        self.cache = DisassemblyCache(emulator.memory)
+        self.top = None
+        self.row_addrs = []
+        self.shown = [None] * self.ROWS
+        self.shown_registers = None
+        self.trace = None
         
-        # ROM: $00-$3F (LoROM)
-        if bank < 0x40 and offset >= 0x8000:
-            if bank < len(self.rom_banks):
-                return self.rom_banks[bank][offset - 0x8000]
+        self.window = tk.Toplevel(emulator.master)
+        self.window.title("Debugger")
+        self.window.configure(bg='#1e1e1e')
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
         
-        return 0
-    
-    def write(self, addr, value):
-        """Write byte to memory address"""
-        bank = (addr >> 16) & 0xFF
-        offset = addr & 0xFFFF
-        value = value & 0xFF
+        toolbar = tk.Frame(self.window, bg='#1e1e1e')
+        toolbar.pack(side=tk.TOP, fill=tk.X)
+        tk.Button(toolbar, text="Step", command=self.step,
+                 bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                 padx=10).pack(side=tk.LEFT, padx=5, pady=3)
+        tk.Button(toolbar, text="Run/Pause", command=emulator.toggle_pause,
+                 bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                 padx=10).pack(side=tk.LEFT, padx=5, pady=3)
+        self.trace_button = tk.Button(toolbar, text="Trace", command=self.toggle_trace,
+                 bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                 padx=10)
+        self.trace_button.pack(side=tk.LEFT, padx=5, pady=3)
         
-        # WRAM
-        if bank == 0x7E or bank == 0x7F:
-            self.wram[((bank - 0x7E) << 16) | offset] = value
-        elif offset < 0x2000:
-            self.wram[offset] = value
-
-class CPU65C816:
-    """65C816 CPU Emulation"""
-    def __init__(self, memory):
-        self.mem = memory
-        self.a = 0      # Accumulator
-        self.x = 0      # X index
-        self.y = 0      # Y index
-        self.sp = 0x1FF # Stack pointer
-        self.pc = 0     # Program counter
-        self.pb = 0     # Program bank
-        self.db = 0     # Data bank
-        self.p = 0x34   # Processor status
-        self.e = 1      # Emulation mode
-        self.cycles = 0
+        self.registers = tk.Label(self.window, bg='#1e1e1e', fg='#00ff00',
+                                  font=('Courier', 10), anchor=tk.W)
+        self.registers.pack(fill=tk.X, padx=5)
         
-    def reset(self):
-        """Reset CPU to initial state"""
-        reset_vector = self.mem.read(0xFFFC) | (self.mem.read(0xFFFD) << 8)
-        self.pc = reset_vector
-        self.pb = 0
-        self.sp = 0x1FF
-        self.p = 0x34
-        self.e = 1
+        self.rows = []
+        for i in range(self.ROWS):
+            row = tk.Label(self.window, bg='#2b2b2b', fg='white',
+                           font=('Courier', 10), anchor=tk.W, width=40)
+            row.pack(fill=tk.X, padx=5)
+            row.bind('<Button-1>', lambda e, i=i: self.toggle_breakpoint(i))
+            self.rows.append(row)
+        self.refresh()
+        
+    def layout(self, top, m_flag, x_flag):
+        self.top = top
+        self.row_addrs = []
+        addr = top
+        for _ in range(self.ROWS):
+            self.row_addrs.append(addr)
+            _, length = self.cache.get(addr, m_flag, x_flag)
+            addr = (addr & 0xFF0000) | ((addr + length) & 0xFFFF)
+        
+    def refresh(self):
+        """Redraw rows whose text changed"""
+        cpu = self.cpu
+        m_flag = bool(cpu.e or cpu.p & 0x20)
+        x_flag = bool(cpu.e or cpu.p & 0x10)
+        pc = (cpu.pb << 16) | cpu.pc
+        if pc not in self.row_addrs:
+            self.layout(pc, m_flag, x_flag)
         
+        breakpoints = self.emulator.debugger.breakpoints
+        for i, addr in enumerate(self.row_addrs):
+            text, _ = self.cache.get(addr, m_flag, x_flag)
+            line = (f"{'*' if addr in breakpoints else ' '}{'>' if addr == pc else ' '}"
+                    f" ${addr:06X}  {text}")
+            if line != self.shown[i]:
+                self.rows[i].config(text=line)
+                self.shown[i] = line
+        
+        registers = (f"A:{cpu.a:04X} X:{cpu.x:04X} Y:{cpu.y:04X} S:{cpu.sp:04X} "
+                     f"P:{cpu.p & 0xFF:02X} DB:{cpu.db:02X} E:{cpu.e} CYC:{cpu.cycles}")
+        if registers != self.shown_registers:
+            self.registers.config(text=registers)
+            self.shown_registers = registers
+    
     def step(self):
-        """Execute one instruction"""
-        if len(self.mem.rom) == 0:
+        """Execute one instruction while paused"""
+        if self.emulator.refused_in_link("Step"):
             return
+        if not self.emulator.paused:
+            self.emulator.toggle_pause()
+        self.emulator.debugger.resume()
+        try:
+            self.cpu.step()
+        except BreakpointHit as hit:
+            self.emulator.status_label.config(text=str(hit))
+        self.refresh()
         
-        opcode = self.fetch_byte()
-        self.execute_opcode(opcode)
-        
-    def fetch_byte(self):
-        """Fetch byte at PC and increment"""
-        addr = (self.pb << 16) | self.pc
-        value = self.mem.read(addr)
-        self.pc = (self.pc + 1) & 0xFFFF
-        return value
+    def toggle_trace(self):
+        """Start logging every instruction to a trace file, or stop"""
+        if self.trace is not None:
+            trace, self.trace = self.trace, None
+            self.trace_button.config(text="Trace")
+            try:
+                trace.stop()
+                self.emulator.status_label.config(
+                    text=f"Trace written: {os.path.basename(trace.path)}")
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to write trace:\n{str(e)}")
+            return
+        filename = filedialog.asksaveasfilename(
+            title="Execution Trace", defaultextension=".trc",
+            filetypes=[("Execution Traces", "*.trc"), ("All Files", "*.*")]
+        )
+        if filename:
+            self.trace = ExecutionTrace(self.cpu, path=filename)
+            self.trace.start()
+            self.trace_button.config(text="Stop Trace")
+            self.emulator.status_label.config(text=f"Tracing: {os.path.basename(filename)}")
     
-    def execute_opcode(self, opcode):
-        """Execute opcode"""
-        # Simplified instruction set - implement key opcodes
-        if opcode == 0xEA:  # NOP
-            self.cycles += 2
-        elif opcode == 0x18:  # CLC
-            self.p &= ~0x01
-            self.cycles += 2
-        elif opcode == 0x38:  # SEC
-            self.p |= 0x01
-            self.cycles += 2
-        elif opcode == 0xA9:  # LDA immediate
-            self.a = self.fetch_byte()
-            self.set_nz(self.a)
-            self.cycles += 2
-        elif opcode == 0xA2:  # LDX immediate
-            self.x = self.fetch_byte()
-            self.set_nz(self.x)
-            self.cycles += 2
-        elif opcode == 0xA0:  # LDY immediate
-            self.y = self.fetch_byte()
-            self.set_nz(self.y)
-            self.cycles += 2
-        elif opcode == 0x4C:  # JMP absolute
-            low = self.fetch_byte()
-            high = self.fetch_byte()
-            self.pc = low | (high << 8)
-            self.cycles += 3
+    def toggle_breakpoint(self, row):
+        if row >= len(self.row_addrs):
+            return
+        addr = self.row_addrs[row]
+        debugger = self.emulator.debugger
+        if addr in debugger.breakpoints:
+            debugger.remove_breakpoint(addr)
         else:
-            self.cycles += 2
-            
-    def set_nz(self, value):
-        """Set Negative and Zero flags"""
-        self.p = (self.p & ~0x82) | (0x80 if value & 0x80 else 0) | (0x02 if value == 0 else 0)
+            debugger.add_breakpoint(addr)
+        self.refresh()
+        
+    def close(self):
+        if self.trace is not None:
+            self.toggle_trace()
+        self.cache.clear()
+        self.window.destroy()
+        self.emulator.debugger_window = None
 
-class PPU:
-    """Picture Processing Unit - Graphics"""
-    def __init__(self, memory):
-        self.mem = memory
-        self.scanline = 0
-        self.frame_buffer = bytearray(256 * 224 * 3)  # RGB
-        self.bg_mode = 0
-        self.brightness = 15
+class LibraryWindow:
+    """Searchable ROM library browser backed by ROMLibrary"""
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.library = ROMLibrary()
+        self.results = []
+        self.scanning = None
         
-    def render_scanline(self):
-        """Render one scanline"""
-        if self.scanline >= 224:
+        self.window = tk.Toplevel(emulator.master)
+        self.window.title("ROM Library")
+        self.window.configure(bg='#2b2b2b')
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        
+        toolbar = tk.Frame(self.window, bg='#1e1e1e')
+        toolbar.pack(side=tk.TOP, fill=tk.X)
+        tk.Button(toolbar, text="Scan Folder", command=self.scan_folder,
+                 bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                 padx=10).pack(side=tk.LEFT, padx=5, pady=3)
+        self.query = tk.StringVar()
+        self.query.trace_add('write', lambda *args: self.refresh())
+        tk.Entry(toolbar, textvariable=self.query, bg='#3c3c3c', fg='white',
+                 insertbackground='white').pack(side=tk.LEFT, fill=tk.X, expand=True,
+                                                 padx=5, pady=3)
+        
+        self.listbox = tk.Listbox(self.window, bg='#1e1e1e', fg='white',
+                                  font=('Courier', 10), width=80, height=25)
+        self.listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.listbox.bind('<Double-Button-1>', lambda e: self.open_selected())
+        self.listbox.bind('<Return>', lambda e: self.open_selected())
+        
+        self.status = tk.Label(self.window, bg='#1e1e1e', fg='#00ff00',
+                               font=('Courier', 10), anchor=tk.W)
+        self.status.pack(fill=tk.X)
+        self.refresh()
+        
+    def refresh(self):
+        self.results = self.library.search(self.query.get())
+        self.listbox.delete(0, tk.END)
+        for path, title, mapping, crc in self.results:
+            self.listbox.insert(tk.END, f"{title or os.path.basename(path):24} "
+                                        f"{mapping:7} {crc:08X}  {path}")
+        self.status.config(text=f"{len(self.results)} ROMs")
+        
+    def scan_folder(self):
+        directory = filedialog.askdirectory(title="Scan ROM Folder")
+        if not directory or self.scanning is not None:
             return
+        self.status.config(text=f"Scanning {directory}...")
+        self.scanning = {}
         
-        # Simple gradient pattern when no ROM loaded
-        offset = self.scanline * 256 * 3
-        for x in range(256):
-            idx = offset + x * 3
-            self.frame_buffer[idx] = (x + self.scanline) % 256      # R
-            self.frame_buffer[idx + 1] = (x * 2) % 256              # G
-            self.frame_buffer[idx + 2] = (self.scanline * 2) % 256  # B
+        def work(outcome=self.scanning):
+            try:
+                outcome['result'] = self.library.scan([directory])
+            except Exception as e:
+                outcome['error'] = e
+        
+        threading.Thread(target=work, daemon=True).start()
+        self.poll_scan()
+        
+    def poll_scan(self):
+        """Pick up the scan thread's outcome without blocking Tk"""
+        outcome = self.scanning
+        if not outcome:
+            self.window.after(100, self.poll_scan)
+            return
+        self.scanning = None
+        if 'error' in outcome:
+            messagebox.showerror("Error", f"Scan failed:\n{outcome['error']}")
+            return
+        self.refresh()
+        files, updated, removed, failed = outcome['result']
+        status = f"{files} ROMs, {updated} updated, {removed} removed"
+        if failed:
+            status += f", {len(failed)} unreadable"
+        self.status.config(text=status)
+        
+    def open_selected(self):
+        selection = self.listbox.curselection()
+        if selection:
+            self.emulator.open_rom(self.results[selection[0]][0])
     
-    def step(self):
-        """Process one PPU cycle"""
-        self.render_scanline()
-        self.scanline = (self.scanline + 1) % 262
+    def close(self):
+        self.window.destroy()
+        self.emulator.library_window = None
 
-class Controller:
-    """SNES Controller Input"""
-    def __init__(self):
-        self.buttons = {
-            'b': False, 'y': False, 'select': False, 'start': False,
-            'up': False, 'down': False, 'left': False, 'right': False,
-            'a': False, 'x': False, 'l': False, 'r': False
-        }
+class HeatmapWindow:
+    """Live memory heatmap with CSV export; counting runs while it is open"""
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.heatmap = MemoryHeatmap(emulator.memory, emulator.cpu)
         
-    def press(self, button):
-        if button in self.buttons:
-            self.buttons[button] = True
-            
-    def release(self, button):
-        if button in self.buttons:
-            self.buttons[button] = False
+        self.window = tk.Toplevel(emulator.master)
+        self.window.title("Memory Heatmap")
+        self.window.configure(bg='#2b2b2b')
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        
+        toolbar = tk.Frame(self.window, bg='#1e1e1e')
+        toolbar.pack(side=tk.TOP, fill=tk.X)
+        for text, command in (("Clear", self.heatmap.clear), ("Export CSV", self.export)):
+            tk.Button(toolbar, text=text, command=command,
+                     bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                     padx=10).pack(side=tk.LEFT, padx=5, pady=3)
+        
+        self.canvas = tk.Canvas(self.window, width=512, height=512,
+                                bg='black', highlightthickness=0)
+        self.canvas.pack(padx=5, pady=5)
+        self.canvas.bind('<Motion>', self.hover)
+        self.status = tk.Label(self.window, bg='#1e1e1e', fg='#00ff00',
+                               font=('Courier', 10), anchor=tk.W,
+                               text="R writes  G reads  B executes")
+        self.status.pack(fill=tk.X)
+        self.heatmap.start()
+        self.refresh()
+        
+    def refresh(self):
+        if self.window is None:
+            return
+        img = tk.PhotoImage(data=self.heatmap.image()).zoom(2)
+        self.canvas.delete("all")
+        self.canvas.create_image(256, 256, image=img)
+        self.canvas.image = img
+        self.window.after(500, self.refresh)
+    
+    def hover(self, event):
+        page = (min(max(event.y, 0), 511) // 2) << 8 | min(max(event.x, 0), 511) // 2
+        counts = [self.heatmap.counts[kind][page] for kind in MemoryHeatmap.KINDS]
+        self.status.config(text=f"${page << 8:06X}  reads {counts[0]}  "
+                                f"writes {counts[1]}  executes {counts[2]}")
+    
+    def export(self):
+        filename = filedialog.asksaveasfilename(
+            title="Export Heatmap", defaultextension=".csv",
+            filetypes=[("CSV", "*.csv"), ("All Files", "*.*")]
+        )
+        if filename:
+            try:
+                self.heatmap.export_csv(filename)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to export heatmap:\n{str(e)}")
+    
+    def close(self):
+        self.heatmap.stop()
+        self.window.destroy()
+        self.window = None
+        self.emulator.heatmap_window = None
+
+TURBO_SLICE = 0.030  # seconds of emulation per UI tick while fast-forwarding
+TURBO_AUDIO_MODES = ('mute', 'stretch')
 
 class SNESEmulator:
     """Main SNES Emulator"""
-    def __init__(self, master):
+    def __init__(self, master, rewind_budget=64 * 1024 * 1024, run_ahead=0,
+                 turbo=False, turbo_audio='stretch', capture_policy='drop', link=None,
+                 scale=2, frameskip=0, timing='fast', wav=None):
         self.master = master
         self.master.title("SNES ZMZ Emulator")
-        self.master.geometry("800x600")
+        self.master.geometry(f"{max(800, 256 * scale + 40)}x{224 * scale + 150}")
         self.master.configure(bg='#2b2b2b')
         
         # Initialize components
-        self.memory = Memory()
-        self.cpu = CPU65C816(self.memory)
-        self.ppu = PPU(self.memory)
-        self.controller = Controller()
+        self.core = SNESCore(timing)
+        self.memory = self.core.memory
+        self.cpu = self.core.cpu
+        self.ppu = self.core.ppu
+        self.apu = self.core.apu
+        self.controller = self.core.controller
+        self.debugger = self.core.debugger
+        self.debugger_window = None
+        self.library_window = None
+        self.heatmap_window = None
+        self.loop_started = False
+        self.rom_cache = ROMCache()
+        self.sram_flushed = time.perf_counter()
         
         self.running = False
         self.paused = False
         self.rom_loaded = False
+        self.audio_output = None
+        self.wav = WAVWriter(wav) if wav else None  # records every frame's audio
+        if self.wav is not None:
+            self.core.audio_sinks.append(self.wav)
+        self.rewind = RewindBuffer(rewind_budget) if rewind_budget else None
+        self.rewinding = False
+        self.run_ahead = run_ahead  # frames emulated ahead of the shown one
+        self.run_ahead_frames = run_ahead or 1  # what the Run-Ahead toggle turns on
+        self.turbo = turbo  # fast-forward latched on from the command line
+        self.turbo_held = False
+        self.turbo_audio = turbo_audio
+        self.capture = None
+        self.capture_policy = capture_policy
+        self.link = link  # LinkSession, if playing over a link
+        # The keyboard drives our own pad; in link play the session copies
+        # it to whichever port we are and fills the other from the peer
+        self.keypad = Controller() if link else self.controller
+        self.scale = scale
+        self.frameskip = frameskip  # frames emulated undrawn between drawn ones
+        self.skipped = 0
         
         self.setup_ui()
         self.bind_keys()
+        self.master.protocol("WM_DELETE_WINDOW", self.on_close)
         
     def setup_ui(self):
         """Setup user interface"""
@@ -215,6 +3523,10 @@ class SNESEmulator:
                  bg='#3c3c3c', fg='white', relief=tk.FLAT, 
                  padx=10).pack(side=tk.LEFT, padx=5, pady=3)
         
+        tk.Button(menubar, text="Library", command=self.open_library,
+                 bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                 padx=10).pack(side=tk.LEFT, padx=5, pady=3)
+        
         tk.Button(menubar, text="Reset", command=self.reset_emulator,
                  bg='#3c3c3c', fg='white', relief=tk.FLAT,
                  padx=10).pack(side=tk.LEFT, padx=5, pady=3)
@@ -223,8 +3535,48 @@ class SNESEmulator:
                  bg='#3c3c3c', fg='white', relief=tk.FLAT,
                  padx=10).pack(side=tk.LEFT, padx=5, pady=3)
         
+        tk.Button(menubar, text="Save State", command=self.save_state,
+                 bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                 padx=10).pack(side=tk.LEFT, padx=5, pady=3)
+        
+        tk.Button(menubar, text="Load State", command=self.load_state,
+                 bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                 padx=10).pack(side=tk.LEFT, padx=5, pady=3)
+        
+        self.record_button = tk.Button(menubar, text="Record", command=self.toggle_recording,
+                 bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                 padx=10)
+        self.record_button.pack(side=tk.LEFT, padx=5, pady=3)
+        
+        tk.Button(menubar, text="Play Movie", command=self.play_movie,
+                 bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                 padx=10).pack(side=tk.LEFT, padx=5, pady=3)
+        
+        self.capture_button = tk.Button(menubar, text="Capture", command=self.toggle_capture,
+                 bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                 padx=10)
+        self.capture_button.pack(side=tk.LEFT, padx=5, pady=3)
+        
+        self.run_ahead_button = tk.Button(menubar, text=self.run_ahead_text(),
+                 command=self.toggle_run_ahead,
+                 bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                 padx=10)
+        self.run_ahead_button.pack(side=tk.LEFT, padx=5, pady=3)
+        
+        tk.Button(menubar, text="Debugger", command=self.open_debugger,
+                 bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                 padx=10).pack(side=tk.LEFT, padx=5, pady=3)
+        
+        tk.Button(menubar, text="Cheat", command=self.add_cheat,
+                 bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                 padx=10).pack(side=tk.LEFT, padx=5, pady=3)
+        
+        tk.Button(menubar, text="Heatmap", command=self.open_heatmap,
+                 bg='#3c3c3c', fg='white', relief=tk.FLAT,
+                 padx=10).pack(side=tk.LEFT, padx=5, pady=3)
+        
         # Display canvas
-        self.canvas = tk.Canvas(self.master, width=512, height=448, 
+        self.canvas = tk.Canvas(self.master, width=256 * self.scale, height=224 * self.scale, 
                                bg='black', highlightthickness=0)
         self.canvas.pack(pady=20)
         
@@ -255,6 +3607,7 @@ class SNESEmulator:
         Shift       - Select
         Q           - L Button
         W           - R Button
+        Backspace   - Rewind (hold)
         """
         
         tk.Label(info_frame, text=controls_text, bg='#2b2b2b', fg='white',
@@ -272,76 +3625,388 @@ class SNESEmulator:
         for key, button in key_map.items():
             # Use consistent format for all keys
             self.master.bind(f'<{key}>', 
-                           lambda e, b=button: self.controller.press(b))
+                           lambda e, b=button: self.keypad.press(b))
             self.master.bind(f'<KeyRelease-{key}>', 
-                           lambda e, b=button: self.controller.release(b))
+                           lambda e, b=button: self.keypad.release(b))
+        
+        self.master.bind('<BackSpace>', lambda e: self.set_rewinding(True))
+        self.master.bind('<KeyRelease-BackSpace>', lambda e: self.set_rewinding(False))
+        self.master.bind('<Tab>', lambda e: self.set_turbo_held(True) or 'break')
+        self.master.bind('<KeyRelease-Tab>', lambda e: self.set_turbo_held(False))
+    
+    def set_rewinding(self, active):
+        if active and self.refused_in_link("Rewind"):
+            return
+        self.rewinding = active and self.rewind is not None
+    
+    def refused_in_link(self, action):
+        """True, saying so in the status bar, while link play is on: action
+        would change this side's emulation only and desync it from the peer"""
+        if self.link is None:
+            return False
+        self.status_label.config(text=f"{action} is off during link play")
+        return True
+    
+    def set_turbo_held(self, active):
+        if self.turbo_held and not active and not self.turbo and not self.paused:
+            self.status_label.config(text="Running")
+        self.turbo_held = active
     
     def load_rom(self):
         """Load SNES ROM file"""
+        if self.rom_loaded and self.refused_in_link("Load ROM"):
+            return
         filename = filedialog.askopenfilename(
             title="Select SNES ROM",
-            filetypes=[("SNES ROMs", "*.smc *.sfc"), ("All Files", "*.*")]
+            filetypes=[("SNES ROMs", "*.smc *.sfc *.fig *.swc *.zip *.gz"), ("All Files", "*.*")]
         )
         
         if filename:
-            try:
-                with open(filename, 'rb') as f:
-                    rom_data = f.read()
-                
-                # Skip copier header if present (512 bytes)
-                if len(rom_data) % 1024 == 512:
-                    rom_data = rom_data[512:]
-                
-                self.memory.load_rom(rom_data)
-                self.cpu.reset()
-                self.rom_loaded = True
-                self.running = True
-                
-                rom_name = os.path.basename(filename)
-                self.status_label.config(text=f"Loaded: {rom_name}")
+            self.open_rom(filename)
+    
+    def open_rom(self, filename, notify=True):
+        """Load a ROM file and start emulating it
+        
+        In link play only the first ROM is let through: the session's
+        handshake happens once, so a second one would desync the peer.
+        """
+        if self.rom_loaded and self.refused_in_link("Load ROM"):
+            return
+        try:
+            patch = self.core.load_rom_file(filename, self.rom_cache)
+            if self.rewind is not None:
+                self.rewind.clear()
+            if self.link is not None:
+                self.link.start(self.core)
+            self.start_audio()
+            self.rom_loaded = True
+            self.running = True
+            
+            rom_name = os.path.basename(filename)
+            if patch:
+                rom_name += f" + {os.path.basename(patch)}"
+            self.status_label.config(text=f"Loaded: {rom_name}")
+            header = self.memory.header
+            if notify:
                 messagebox.showinfo("ROM Loaded", 
                                   f"Successfully loaded {rom_name}\n"
-                                  f"Size: {len(rom_data)} bytes")
-                
+                                  f"Title: {header.title if header else '?'}\n"
+                                  f"Mapping: {self.memory.mapping}\n"
+                                  f"Size: {len(self.memory.rom)} bytes")
+            
+            if not self.loop_started:
+                self.loop_started = True
                 self.run_emulator()
-                
+            
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load ROM:\n{str(e)}")
+    
+    def open_library(self):
+        if self.rom_loaded and self.refused_in_link("Library"):
+            return
+        if self.library_window is None:
+            self.library_window = LibraryWindow(self)
+        else:
+            self.library_window.window.lift()
+    
+    def open_debugger(self):
+        if self.debugger_window is None:
+            self.debugger_window = DebuggerWindow(self)
+        else:
+            self.debugger_window.window.lift()
+    
+    def open_heatmap(self):
+        if self.heatmap_window is None:
+            self.heatmap_window = HeatmapWindow(self)
+        else:
+            self.heatmap_window.window.lift()
+    
+    def start_audio(self):
+        """Route core audio to the sound card, if there is one"""
+        if self.audio_output is not None:
+            return
+        output = AudioOutput()
+        if output.start():
+            self.audio_output = output
+            self.core.audio_sinks.append(output)
+    
+    def on_close(self):
+        """Release the audio device and finish files before the window goes away"""
+        self.running = False
+        # Closing the tool windows stops their hooks and finishes any trace
+        if self.debugger_window is not None:
+            self.debugger_window.close()
+        if self.heatmap_window is not None:
+            self.heatmap_window.close()
+        self.memory.flush_sram()
+        if self.link is not None:
+            self.link.close()
+        if self.capture is not None:
+            try:
+                self.capture.close()
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to write capture:\n{str(e)}")
+        if self.audio_output is not None:
+            self.audio_output.close()
+        if self.wav is not None:
+            self.wav.close()
+        self.master.destroy()
+    
+    def save_state(self):
+        """Write a compressed savestate to a file"""
+        if self.refused_in_link("Save State"):
+            return
+        filename = filedialog.asksaveasfilename(
+            title="Save State", defaultextension=".sst",
+            filetypes=[("Savestates", "*.sst"), ("All Files", "*.*")]
+        )
+        if filename:
+            try:
+                with open(filename, 'wb') as f:
+                    f.write(self.core.save_state('zlib'))
+                self.status_label.config(text=f"Saved: {os.path.basename(filename)}")
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to save state:\n{str(e)}")
+    
+    def load_state(self):
+        """Restore a savestate from a file"""
+        if self.refused_in_link("Load State"):
+            return
+        filename = filedialog.askopenfilename(
+            title="Load State",
+            filetypes=[("Savestates", "*.sst"), ("All Files", "*.*")]
+        )
+        if filename:
+            try:
+                with open(filename, 'rb') as f:
+                    self.core.load_state(f.read())
+                self.status_label.config(text=f"Loaded: {os.path.basename(filename)}")
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to load state:\n{str(e)}")
+    
+    def toggle_recording(self):
+        """Start recording from power-on, or stop and save the movie"""
+        if not self.rom_loaded or self.refused_in_link("Recording"):
+            return
+        if self.core.movie is None or self.core.movie_playing:
+            self.core.start_recording()
+            self.record_button.config(text="Stop")
+            self.status_label.config(text="Recording movie")
+            return
+        
+        movie = self.core.stop_movie()
+        self.record_button.config(text="Record")
+        filename = filedialog.asksaveasfilename(
+            title="Save Movie", defaultextension=".zmv",
+            filetypes=[("Movies", "*.zmv"), ("All Files", "*.*")]
+        )
+        if filename:
+            try:
+                movie.save(filename)
+                self.status_label.config(text=f"Saved movie: {len(movie.frames)} frames")
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to save movie:\n{str(e)}")
+    
+    def toggle_capture(self):
+        """Start capturing shown frames to Y4M or PNGs, or stop capturing"""
+        if self.capture is not None:
+            capture, self.capture = self.capture, None
+            self.capture_button.config(text="Capture")
+            try:
+                frames, dropped = capture.close()
+                self.status_label.config(text=f"Captured {frames} frames ({dropped} dropped)")
             except Exception as e:
-                messagebox.showerror("Error", f"Failed to load ROM:\n{str(e)}")
+                messagebox.showerror("Error", f"Failed to write capture:\n{str(e)}")
+            return
+        filename = filedialog.asksaveasfilename(
+            title="Capture Video", defaultextension=".y4m",
+            filetypes=[("Y4M Video", "*.y4m"), ("PNG Sequence", "*.png"), ("All Files", "*.*")]
+        )
+        if filename:
+            try:
+                self.capture = FrameCapture(filename, self.capture_policy)
+                self.capture_button.config(text="Stop Capture")
+                self.status_label.config(text=f"Capturing: {os.path.basename(filename)}")
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to start capture:\n{str(e)}")
+    
+    def play_movie(self):
+        """Replay a movie from power-on"""
+        if not self.rom_loaded or self.refused_in_link("Movie playback"):
+            return
+        filename = filedialog.askopenfilename(
+            title="Play Movie",
+            filetypes=[("Movies", "*.zmv"), ("All Files", "*.*")]
+        )
+        if filename:
+            try:
+                self.core.start_playback(Movie.load(filename))
+                self.record_button.config(text="Record")
+                self.status_label.config(text=f"Playing: {os.path.basename(filename)}")
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to play movie:\n{str(e)}")
+    
+    def add_cheat(self):
+        """Prompt for a cheat code; an enabled code is toggled off again"""
+        if self.refused_in_link("Cheat"):
+            return
+        code = simpledialog.askstring("Cheat", "Game Genie or Pro Action Replay code:",
+                                      parent=self.master)
+        if not code:
+            return
+        try:
+            if code in self.core.cheats:
+                self.core.remove_cheat(code)
+                self.status_label.config(text=f"Cheat off: {code}")
+            else:
+                addr, value = self.core.add_cheat(code)
+                self.status_label.config(text=f"Cheat on: {code} (${addr:06X} = ${value:02X})")
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+    
+    def run_ahead_text(self):
+        return f"Run-Ahead: {self.run_ahead}" if self.run_ahead else "Run-Ahead: Off"
+    
+    def toggle_run_ahead(self):
+        """Switch run-ahead between off and its configured frame count"""
+        self.run_ahead = 0 if self.run_ahead else self.run_ahead_frames
+        self.run_ahead_button.config(text=self.run_ahead_text())
+        self.status_label.config(text=self.run_ahead_text())
     
     def reset_emulator(self):
         """Reset emulator to initial state"""
-        self.cpu.reset()
-        self.ppu.scanline = 0
+        if self.refused_in_link("Reset"):
+            return
+        self.core.reset()
         self.status_label.config(text="Emulator reset")
     
     def toggle_pause(self):
         """Toggle pause state"""
         self.paused = not self.paused
+        if self.paused:
+            self.memory.flush_sram()
+        else:
+            self.debugger.resume()
         status = "Paused" if self.paused else "Running"
         self.status_label.config(text=status)
     
     def run_emulator(self):
         """Main emulation loop"""
         if not self.running or self.paused:
+            self.memory.flush_sram()
             self.master.after(16, self.run_emulator)
             return
+        # Battery saves reach the disk in batches, when Tk is otherwise idle
+        now = time.perf_counter()
+        if self.memory.sram_dirty and now - self.sram_flushed >= SRAM_FLUSH_INTERVAL:
+            self.sram_flushed = now
+            self.master.after_idle(self.memory.flush_sram)
         
-        # Run CPU cycles
-        for _ in range(1000):
-            self.cpu.step()
-        
-        # Run PPU
-        self.ppu.step()
+        if self.link is not None:
+            self.run_link()
+            return
         
-        # Update display every scanline
-        if self.ppu.scanline == 0:
-            self.update_display()
+        # Run one full frame, then show it. While rewinding, step back to
+        # the previous recorded state and re-emulate it for display.
+        if self.rewinding:
+            state = self.rewind.pop()
+            if state is not None:
+                self.core.load_state(state)
+        elif self.rewind is not None:
+            self.rewind.push(self.core.save_state())
+        if (self.turbo or self.turbo_held) and not self.rewinding:
+            self.run_turbo()
+            return
+        try:
+            if self.run_ahead and not self.rewinding:
+                self.core.run_ahead(self.run_ahead)
+            else:
+                draw = self.skipped >= self.frameskip
+                self.skipped = 0 if draw else self.skipped + 1
+                self.core.run_frame(render=draw)
+                if not draw:
+                    self.master.after(16, self.run_emulator)
+                    return
+        except BreakpointHit as hit:
+            self.paused = True
+            self.status_label.config(text=str(hit))
+        self.update_display()
+        if self.debugger_window is not None:
+            self.debugger_window.refresh()
         
         # Continue loop at ~60 FPS
         self.master.after(16, self.run_emulator)
     
+    def run_link(self):
+        """One link play tick; rewind, run-ahead, fast-forward and
+        breakpoints are off since both sides must emulate exactly the same
+        frames, each run whole and once"""
+        link = self.link
+        debugger = self.core.debugger
+        debugger.enabled = False
+        try:
+            advanced = link.advance(self.core, self.keypad.state())
+        except (ConnectionError, OSError) as e:
+            self.running = False
+            self.memory.attach_battery()  # detached by the session's power-on
+            self.status_label.config(text=f"Link closed: {e}")
+            self.master.after(16, self.run_emulator)
+            return
+        finally:
+            debugger.enabled = True
+        if advanced:
+            self.update_display()
+            self.status_label.config(
+                text=f"Link: player {link.port + 1}, delay {link.delay}, "
+                     f"{link.frame - 1 - link.confirmed} frames predicted, "
+                     f"{link.rollbacks} rollbacks")
+        elif not link.peer_ready:
+            self.status_label.config(text="Link: waiting for the other player")
+        self.master.after(16 if advanced else 1, self.run_emulator)
+    
+    def run_turbo(self):
+        """One fast-forward tick: emulate unpaced for TURBO_SLICE, drawing
+        only the last frame, so N adapts to what the core can deliver
+        
+        The sound card either gets nothing or just the last frame's samples,
+        which shortens the audio by dropping whole frames at normal pitch.
+        Other audio sinks (WAV recording) still see every frame.
+        """
+        core = self.core
+        sinks = core.audio_sinks
+        output = self.audio_output
+        if output is not None:
+            sinks.remove(output)
+        start = time.perf_counter()
+        frames = 0
+        try:
+            while True:
+                last = time.perf_counter() - start >= TURBO_SLICE
+                core.run_frame(render=last)
+                frames += 1
+                if last:
+                    break
+        except BreakpointHit as hit:
+            self.paused = True
+            self.status_label.config(text=str(hit))
+        finally:
+            if output is not None:
+                sinks.append(output)
+        if output is not None and self.turbo_audio == 'stretch' and core.audio is not None:
+            output.write(core.audio)
+        elapsed = time.perf_counter() - start
+        if not self.paused:
+            speed = frames / (elapsed * APU.FRAME_RATE)
+            self.status_label.config(text=f"Fast-forward {speed:.1f}x ({frames} frames/tick)")
+        self.update_display()
+        if self.debugger_window is not None:
+            self.debugger_window.refresh()
+        self.master.after(1, self.run_emulator)
+    
     def update_display(self):
         """Update screen display"""
+        if self.capture is not None:
+            self.capture.write(self.ppu.frame_buffer)
         # Convert frame buffer to PhotoImage format
         try:
             # Create PPM image data
@@ -350,15 +4015,215 @@ class SNESEmulator:
             
             # Update canvas
             img = tk.PhotoImage(data=ppm_data)
+            if self.scale > 1:
+                img = img.zoom(self.scale)
             self.canvas.delete("all")
-            self.canvas.create_image(256, 224, image=img)
+            self.canvas.create_image(128 * self.scale, 112 * self.scale, image=img)
             self.canvas.image = img  # Keep reference
         except Exception as e:
             pass  # Silently handle display errors
 
+class StartupProfile:
+    """Wall-clock time per startup stage, for --startup-profile"""
+    def __init__(self, start=MODULE_START):
+        self.start = self.last = start
+        self.stages = []
+        
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+    
+    def report(self):
+        lines = [f"{stage:24} {seconds * 1000:8.1f} ms" for stage, seconds in self.stages]
+        lines.append(f"{'total':24} {(self.last - self.start) * 1000:8.1f} ms")
+        return '\n'.join(lines)
+
+def run_headless(core, frames, frameskip=0, profile=None, wav=None, trace=None):
+    """Emulate frames frames without a window; returns a summary line
+    
+    With wav, every frame's audio is also written to that WAV file, and
+    with trace every instruction is logged to that execution trace file.
+    """
+    writer = WAVWriter(wav) if wav else None
+    if writer is not None:
+        core.audio_sinks.append(writer)
+    tracer = ExecutionTrace(core.cpu, path=trace) if trace else None
+    if tracer is not None:
+        tracer.start()
+    start = time.perf_counter()
+    try:
+        for frame in range(frames):
+            core.run_frame(render=frame % (frameskip + 1) == frameskip)
+            if frame == 0 and profile is not None:
+                profile.mark('first frame')
+    finally:
+        if tracer is not None:
+            tracer.stop()
+        if writer is not None:
+            core.audio_sinks.remove(writer)
+            writer.close()
+    elapsed = time.perf_counter() - start
+    core.memory.flush_sram()
+    digest = hashlib.sha1(core.save_state()).hexdigest()
+    return (f"{frames} frames in {elapsed:.2f}s ({frames / max(elapsed, 1e-9):.1f} fps)  "
+            f"state {digest[:16]}")
+
 def main():
+    parser = argparse.ArgumentParser(description="SNES ZMZ Emulator")
+    parser.add_argument('rom', nargs='?',
+                        help="ROM to start (.sfc, .smc, .fig, .swc, or a .zip/.gz holding one)")
+    parser.add_argument('--scale', type=int, default=2,
+                        help="window scale factor")
+    parser.add_argument('--frameskip', type=int, default=0,
+                        help="frames emulated without drawing after each drawn frame")
+    parser.add_argument('--headless', action='store_true',
+                        help="run ROM without a window for --frames frames "
+                             "(or until --movie ends) and print a summary")
+    parser.add_argument('--movie', metavar='PATH',
+                        help="play a .zmv movie from power-on")
+    parser.add_argument('--wav', metavar='PATH',
+                        help="also record the audio to a WAV file")
+    parser.add_argument('--startup-profile', action='store_true',
+                        help="print the time spent in each startup stage")
+    parser.add_argument('--benchmark', nargs='*', metavar='MIX',
+                        choices=list(BENCHMARK_MIXES),
+                        help="run synthetic ROM benchmarks headlessly (default: all)")
+    parser.add_argument('--frames', type=int, default=60,
+                        help="frames per benchmark, batch ROM run or headless run")
+    parser.add_argument('--json', metavar='PATH',
+                        help="also write benchmark or batch results to PATH as JSON")
+    parser.add_argument('--timing', choices=CPU_TIMING_PROFILES, default='fast',
+                        help="CPU cycle accounting: opcode tables only, or also "
+                             "memory speed, direct page and page-crossing penalties")
+    parser.add_argument('--profile', action='store_true',
+                        help="print an opcode/PC profile for each benchmark")
+    parser.add_argument('--trace', metavar='PATH',
+                        help="log every instruction of a --headless run to an "
+                             "execution trace file (read it with --decode-trace)")
+    parser.add_argument('--decode-trace', metavar='PATH',
+                        help="print an execution trace file as text")
+    parser.add_argument('--batch', nargs='+', metavar='PATH',
+                        help="run ROMs and .zmv movies headlessly in a process pool "
+                             "and report per-frame hashes")
+    parser.add_argument('--workers', type=int,
+                        help="batch worker processes (default: one per CPU)")
+    parser.add_argument('--capture-policy', choices=('drop', 'block'), default='drop',
+                        help="when video capture falls behind, drop frames or wait")
+    parser.add_argument('--link-host', metavar='ADDRESS',
+                        help="host two-player link play on host:port or a Unix socket path")
+    parser.add_argument('--link-connect', metavar='ADDRESS',
+                        help="join link play hosted at host:port or a Unix socket path")
+    parser.add_argument('--input-delay', type=int, default=2,
+                        help="link play input delay in frames")
+    parser.add_argument('--rollback', type=int, default=8,
+                        help="most frames link play may predict before it waits")
+    parser.add_argument('--run-ahead', type=int, default=0, metavar='N',
+                        help="emulate N frames ahead of the shown one to hide input lag "
+                             "(toggle with the Run-Ahead button)")
+    parser.add_argument('--rewind-budget', type=int, default=64, metavar='MB',
+                        help="memory for rewind states in MiB (hold Backspace to "
+                             "rewind); 0 turns rewind off")
+    parser.add_argument('--turbo', action='store_true',
+                        help="start in fast-forward (hold Tab for it otherwise)")
+    parser.add_argument('--turbo-audio', choices=TURBO_AUDIO_MODES, default='stretch',
+                        help="audio while fast-forwarding")
+    args = parser.parse_args()
+    if args.run_ahead < 0:
+        parser.error("--run-ahead must not be negative")
+    if args.rewind_budget < 0:
+        parser.error("--rewind-budget must not be negative")
+    profile = StartupProfile()
+    profile.mark('imports and arguments')
+    
+    if args.decode_trace:
+        for line in decode_trace(args.decode_trace):
+            print(line)
+        return
+    
+    if args.batch:
+        report = run_batch(args.batch, args.frames, args.workers)
+        for r in report['results']:
+            name = os.path.basename(r['rom'])
+            if r['movie']:
+                name += f" < {os.path.basename(r['movie'])}"
+            outcome = r.get('error') or f"{r['frames']} frames  state {r['state_digest'][:16]}"
+            print(f"{name:40} {outcome}  {r['seconds']:.2f}s")
+        print(f"{len(report['results'])} runs, {report['failed']} failed, "
+              f"{report['frames']} frames in {report['seconds']:.2f}s  digest {report['digest']}")
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+        return
+    
+    if args.benchmark is not None:
+        report = run_benchmark(args.benchmark, args.frames, args.timing)
+        for r in report['results']:
+            parts = r['component_seconds']
+            print(f"{r['mix']:8} {r['instructions_per_sec']:12,.0f} instr/s "
+                  f"{r['cycles'] / r['frames']:8,.0f} cyc/frame "
+                  f"{r['frames_per_sec']:7.2f} fps  cpu {parts['cpu']:.3f}s "
+                  f"ppu {parts['ppu']:.3f}s apu {parts['apu']:.3f}s")
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+        if args.profile:
+            for name in args.benchmark or BENCHMARK_MIXES:
+                core = SNESCore(args.timing)
+                core.load_rom(build_benchmark_rom(name, BENCHMARK_MIXES[name]))
+                profiler = CPUProfiler(core.cpu)
+                profiler.start()
+                for _ in range(args.frames):
+                    core.run_frame(render=False)
+                profiler.stop()
+                print(f"\n== {name} ==")
+                print(profiler.report())
+        return
+    
+    if args.headless:
+        if not args.rom:
+            parser.error("--headless needs a ROM")
+        core = SNESCore(args.timing)
+        profile.mark('core')
+        core.load_rom_file(args.rom, battery=False)
+        profile.mark('ROM load')
+        frames = args.frames
+        if args.movie:
+            movie = Movie.load(args.movie)
+            core.start_playback(movie)
+            frames = len(movie.frames)
+        summary = run_headless(core, frames, args.frameskip, profile, args.wav, args.trace)
+        if args.startup_profile:
+            print(profile.report(), file=sys.stderr)
+        print(summary)
+        return
+    
+    link = None
+    options = {'delay': args.input_delay, 'max_rollback': args.rollback}
+    if args.link_host:
+        print(f"Waiting for player 2 on {args.link_host}...")
+        link = LinkSession.host(args.link_host, **options)
+    elif args.link_connect:
+        link = LinkSession.connect(args.link_connect, **options)
+    
     root = tk.Tk()
-    emulator = SNESEmulator(root)
+    profile.mark('Tk')
+    emulator = SNESEmulator(root, rewind_budget=args.rewind_budget * 1024 * 1024,
+                            run_ahead=args.run_ahead, turbo=args.turbo,
+                            turbo_audio=args.turbo_audio,
+                            capture_policy=args.capture_policy, link=link,
+                            scale=args.scale, frameskip=args.frameskip,
+                            timing=args.timing, wav=args.wav)
+    profile.mark('UI')
+    if args.rom:
+        # Opening a ROM runs its first frame straight away
+        emulator.open_rom(args.rom, notify=False)
+        if args.movie and emulator.rom_loaded:
+            emulator.core.start_playback(Movie.load(args.movie))
+            emulator.status_label.config(text=f"Playing: {os.path.basename(args.movie)}")
+        profile.mark('ROM load and first frame')
+    if args.startup_profile:
+        print(profile.report(), file=sys.stderr)
     root.mainloop()
 
 if __name__ == "__main__":